@@ -0,0 +1,144 @@
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from fastapi import Request, Response, status
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from dotenv import load_dotenv
+from app.db import pin_primary
+
+load_dotenv()
+
+# Single posts are invalidated on every write in every worker (POST_CACHE_CHANNEL), the TTL
+# only bounds drift while a worker's LISTEN connection is down
+POST_CACHE_CHANNEL = "post_cache"
+POST_CACHE_TTL = float(os.getenv("POST_CACHE_TTL", "60"))
+POST_CACHE_SIZE = int(os.getenv("POST_CACHE_SIZE", "10000"))
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Weak comparison of If-None-Match against our etag, as RFC 9110 asks for."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+def json_response(request: Request, body: bytes, etag: str, max_age: int = 0) -> Response:
+    headers = {"ETag": etag, "Cache-Control": f"private, max-age={max_age}"}
+    if etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+class ResponseCache:
+    """
+    In-memory cache of pre-serialized JSON bodies shared by every request of a worker.
+    An entry is fresh for `ttl` seconds, then served stale for up to `stale_ttl` more
+    seconds while a single refresh runs in the background. `max_age` is what clients
+    are told and defaults to the ttl.
+    """
+
+    def __init__(self, ttl: float, stale_ttl: float = 0, max_entries: int = 1024, max_age: int | None = None):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.max_age = int(ttl) if max_age is None else max_age
+        # key -> (body, etag, fresh_until, stale_until), oldest first
+        self._entries: OrderedDict = OrderedDict()
+        # key -> asyncio.Task currently loading that key
+        self._inflight: dict = {}
+
+    async def get(self, key, loader) -> tuple[bytes, str]:
+        """
+        Returns (body, etag) for key. `loader` is an async callable returning the body,
+        or a (body, etag) tuple when the caller has a cheaper etag than hashing the body.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            body, etag, fresh_until, stale_until = entry
+            now = time.monotonic()
+            if now < fresh_until:
+                self._entries.move_to_end(key)
+                return body, etag
+            if now < stale_until:
+                # Stale-while-revalidate: answer now, refresh once behind the scenes
+                self._load(key, loader)
+                return body, etag
+        # shield so one client disconnecting doesn't cancel the load for everyone else
+        return await asyncio.shield(self._load(key, loader))
+
+    async def respond(self, request: Request, key, loader) -> Response:
+        body, etag = await self.get(key, loader)
+        return json_response(request, body, etag, max_age=self.max_age)
+
+    def invalidate(self, key=None):
+        if key is None:
+            self._entries.clear()
+            self._inflight.clear()
+        else:
+            self._entries.pop(key, None)
+            # Detach any running load so its (possibly outdated) result is not stored
+            self._inflight.pop(key, None)
+
+    def _load(self, key, loader) -> asyncio.Task:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(key, loader))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        return task
+
+    async def _fetch(self, key, loader) -> tuple[bytes, str]:
+        result = await loader()
+        body, etag = result if isinstance(result, tuple) else (result, make_etag(result))
+        if self._inflight.get(key) is asyncio.current_task():
+            now = time.monotonic()
+            self._entries[key] = (body, etag, now + self.ttl, now + self.ttl + self.stale_ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return body, etag
+
+    def _done(self, key, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Background refreshes have nobody awaiting them, mark the error as seen
+        if not task.cancelled():
+            task.exception()
+
+
+# Serialized Post_out by post id. Every handler that changes a post, its votes or its
+# comment count calls publish_invalidation(session, post_id) before committing (the other
+# workers) and invalidate_post(post_id) after (this one, without waiting for the round trip).
+# max_age=0: clients always revalidate, so an invalidation is visible on their next request
+post_cache = ResponseCache(ttl=POST_CACHE_TTL, max_entries=POST_CACHE_SIZE, max_age=0)
+
+def invalidate_post(post_id: int):
+    post_cache.invalidate(post_id)
+    # The reload must not come from a replica that hasn't seen the write yet
+    pin_primary(("post", post_id))
+
+async def publish_invalidation(session: AsyncSession, post_id: int):
+    """Queues invalidate_post(post_id) on every worker; sent on commit, like live.publish_comment. No commit."""
+    await session.execute(text("SELECT pg_notify(:channel, :payload)"),
+                          {"channel": POST_CACHE_CHANNEL, "payload": str(post_id)})
+
+def on_post_invalidated(payload: str | None):
+    """POST_CACHE_CHANNEL listener, payload None when invalidations may have been missed."""
+    if payload is None:
+        post_cache.invalidate()
+    else:
+        invalidate_post(int(payload))
@@ -1,9 +1,19 @@
 from app.model import * 
 from sqlmodel import create_engine
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
-from sqlalchemy import text
+from sqlalchemy import text, event, exc, make_url
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from contextvars import ContextVar
 from dotenv import load_dotenv
+from app import metrics
+import hashlib
+import hmac
+import itertools
+import logging
+import math
 import os
+import time
 
 # Load .env file
 load_dotenv()
@@ -11,14 +21,72 @@ load_dotenv()
 # Get DATABASE_URL from environment
 DATABASE_URL = os.getenv("DATABASE_URL") 
 
+pool_wait_seconds = metrics.Histogram(
+    "db_pool_wait_seconds", "Time spent waiting to check a connection out of the pool", ("pool",)
+)
+pool_timeouts_total = metrics.Counter(
+    "db_pool_timeouts_total", "Checkouts that gave up because the pool stayed exhausted", ("pool",)
+)
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool that records how long each checkout waited, labelled by pool_logging_name."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            pool_timeouts_total.inc(pool=self._orig_logging_name)
+            raise
+        finally:
+            pool_wait_seconds.observe(time.perf_counter() - start, pool=self._orig_logging_name)
+
+# Engine profile, shared by the primary and the replicas. Defaults suit production:
+# no SQL echo (formatting + logging every statement is measurable CPU per request).
+DB_ECHO = os.getenv("DB_ECHO", "false").lower() == "true"
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "false").lower() == "true"
+# SQLAlchemy's compiled-statement cache, per engine
+DB_QUERY_CACHE_SIZE = int(os.getenv("DB_QUERY_CACHE_SIZE", "1000"))
+# asyncpg prepared statements kept per connection
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "500"))
+# Server-side statement_timeout in milliseconds, 0 leaves the server default
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+
+def build_engine(url: str, name: str):
+    connect_args = {}
+    if make_url(url).get_driver_name() == "asyncpg":
+        connect_args["prepared_statement_cache_size"] = DB_STATEMENT_CACHE_SIZE
+        if DB_STATEMENT_TIMEOUT_MS:
+            connect_args["server_settings"] = {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}
+    return create_async_engine(
+        url,
+        echo=DB_ECHO,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        query_cache_size=DB_QUERY_CACHE_SIZE,
+        connect_args=connect_args,
+        poolclass=TimedQueuePool,
+        pool_logging_name=name,
+    )
+
 # Create engine
-engine = create_async_engine(DATABASE_URL, echo=True, pool_size=20, max_overflow=10)
+engine = build_engine(DATABASE_URL, "primary")
 
 async def initialize_vector_extension(engine):
     async with engine.begin() as conn:
         # We use .begin() to ensure it's wrapped in a transaction
         await conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
         print("✅ pgvector extension is ready")
+        # Trigram GIN indexes behind /search/typeahead
+        await conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        print("✅ pg_trgm extension is ready")
 
 
 # expire_on_commit=False is CRITICAL for Async
@@ -26,4 +94,191 @@ async_session_factory = async_sessionmaker(
     bind=engine, 
     class_=AsyncSession, 
     expire_on_commit=False
-)
\ No newline at end of file
+)
+
+
+# Optional read replicas, comma separated. Without them every read goes to the primary.
+DATABASE_READ_URLS = [url.strip() for url in os.getenv("DATABASE_READ_URLS", "").split(",") if url.strip()]
+# How long a replica that dropped a connection is skipped
+READ_REPLICA_RETRY_AFTER = float(os.getenv("READ_REPLICA_RETRY_AFTER", "30"))
+# How long reads stay on the primary after a write, so the writer sees it despite replica lag
+READ_YOUR_WRITES_WINDOW = float(os.getenv("READ_YOUR_WRITES_WINDOW", "5"))
+
+read_replicas_unhealthy_total = metrics.Counter(
+    "db_read_replica_unhealthy_total", "Times a read replica was taken out of rotation", ("replica",)
+)
+
+class ReadReplica:
+    def __init__(self, index: int, url: str):
+        self.name = f"replica{index}"
+        self.engine = build_engine(url, self.name)
+        self.session_factory = async_sessionmaker(bind=self.engine, class_=AsyncSession, expire_on_commit=False)
+        self.down_until = 0.0
+        event.listen(self.engine.sync_engine, "handle_error", self.on_error)
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.down_until
+
+    def on_error(self, context):
+        # Only connectivity problems take a replica out, a bad query is not its fault
+        if context.is_disconnect or isinstance(context.original_exception, OSError):
+            self.down_until = time.monotonic() + READ_REPLICA_RETRY_AFTER
+            read_replicas_unhealthy_total.inc(replica=self.name)
+
+read_replicas = [ReadReplica(i, url) for i, url in enumerate(DATABASE_READ_URLS)]
+_replica_cycle = itertools.cycle(read_replicas)
+
+# key -> monotonic deadline until which reads for that key go to the primary.
+# Keys are ("user", id) for a writer and ("post", id) for a post that was just changed.
+# This worker only: the client's next request may land on another worker, so a write also
+# hands the client a signed pin (ReadYourWritesMiddleware) that every worker honours.
+_primary_pins: dict = {}
+
+# Per request: {"until": unix time} of the pin the client sent, raised by the request's own writes
+_request_pin: ContextVar[dict | None] = ContextVar("request_pin", default=None)
+
+def pin_primary(key):
+    now = time.monotonic()
+    if len(_primary_pins) > 10000:
+        for stale in [k for k, until in _primary_pins.items() if until <= now]:
+            del _primary_pins[stale]
+    _primary_pins[key] = now + READ_YOUR_WRITES_WINDOW
+    request_pin = _request_pin.get()
+    if request_pin is not None:
+        request_pin["until"] = time.time() + READ_YOUR_WRITES_WINDOW
+        request_pin["wrote"] = True
+
+def is_pinned(key) -> bool:
+    request_pin = _request_pin.get()
+    if request_pin is not None and request_pin["until"] > time.time():
+        return True
+    until = _primary_pins.get(key)
+    return until is not None and until > time.monotonic()
+
+
+PIN_COOKIE = "primary_pin"
+PIN_HEADER = b"x-primary-pin"
+_PIN_SECRET = (os.getenv("SECRET_KEY") or "").encode()
+
+def sign_pin(until: int) -> str:
+    return f"{until}.{hmac.new(_PIN_SECRET, str(until).encode(), hashlib.sha256).hexdigest()[:32]}"
+
+def verify_pin(value: str) -> float:
+    """Unix time the pin is valid until, 0 if it is missing, forged or malformed."""
+    until, _, _ = value.partition(".")
+    if not _PIN_SECRET or not until.isdigit() or not hmac.compare_digest(sign_pin(int(until)), value):
+        return 0
+    return float(until)
+
+class ReadYourWritesMiddleware:
+    """
+    Carries the read-your-writes pin across workers. A response to a request that wrote gets
+    the pin as a cookie and an X-Primary-Pin header (for API clients without cookies); a
+    request sending a valid one back reads from the primary until it expires, whichever worker
+    serves it.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not read_replicas:
+            await self.app(scope, receive, send)
+            return
+        until = 0
+        for name, value in scope["headers"]:
+            if name == PIN_HEADER:
+                until = max(until, verify_pin(value.decode("latin-1")))
+            elif name == b"cookie":
+                for cookie in value.decode("latin-1").split(";"):
+                    key, _, pin = cookie.strip().partition("=")
+                    if key == PIN_COOKIE:
+                        until = max(until, verify_pin(pin))
+        request_pin = {"until": until, "wrote": False}
+        token = _request_pin.set(request_pin)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and request_pin["wrote"]:
+                pin = sign_pin(math.ceil(request_pin["until"]))
+                max_age = math.ceil(READ_YOUR_WRITES_WINDOW)
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"set-cookie", f"{PIN_COOKIE}={pin}; Max-Age={max_age}; Path=/; HttpOnly; SameSite=Lax".encode()),
+                    (PIN_HEADER, pin.encode()),
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _request_pin.reset(token)
+
+def read_session(pin_key=None) -> AsyncSession:
+    """
+    Session for read-only work: next healthy replica in round-robin order, or the primary
+    when there are none, none is healthy, or pin_key was written to very recently.
+    """
+    if read_replicas and not (pin_key is not None and is_pinned(pin_key)):
+        for _ in range(len(read_replicas)):
+            replica = next(_replica_cycle)
+            if replica.healthy:
+                return replica.session_factory()
+    return async_session_factory()
+
+# A session that wrote something pins its user (set by oauth2.get_current_user) to the primary on commit
+@event.listens_for(Session, "after_flush")
+def _mark_flush_write(session, flush_context):
+    session.info["wrote"] = True
+
+@event.listens_for(Session, "do_orm_execute")
+def _mark_statement_write(orm_execute_state):
+    if orm_execute_state.is_update or orm_execute_state.is_delete or orm_execute_state.is_insert:
+        orm_execute_state.session.info["wrote"] = True
+
+@event.listens_for(Session, "after_commit")
+def _pin_writer(session):
+    if session.info.pop("wrote", False) and session.info.get("user_id") is not None:
+        pin_primary(("user", session.info["user_id"]))
+
+
+# Regression check for result sizes: with DB_TRACK_FETCH_BYTES=true every statement's rows are
+# measured and added up per endpoint, and any single statement above DB_FETCH_BYTES_WARN is logged.
+# Meant for dev/staging: it buffers results to look at them.
+DB_TRACK_FETCH_BYTES = os.getenv("DB_TRACK_FETCH_BYTES", "false").lower() == "true"
+DB_FETCH_BYTES_WARN = int(os.getenv("DB_FETCH_BYTES_WARN", "16384"))
+
+current_route: ContextVar[str] = ContextVar("current_route", default="-")
+fetched_bytes_total = metrics.Counter(
+    "db_fetched_bytes_total", "Approximate bytes of result rows fetched from the database", ("route",)
+)
+logger = logging.getLogger(__name__)
+
+def estimate_size(value) -> int:
+    if value is None:
+        return 0
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if hasattr(value, "nbytes"):   # pgvector hands back numpy arrays
+        return value.nbytes
+    if isinstance(value, SQLModel):
+        return sum(estimate_size(v) for k, v in value.__dict__.items() if not k.startswith("_sa"))
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_size(v) for v in value)
+    return 8
+
+def track_fetched_bytes(orm_execute_state):
+    if not orm_execute_state.is_select:
+        return None
+    options = orm_execute_state.execution_options
+    if options.get("stream_results") or options.get("yield_per"):
+        return None
+    frozen = orm_execute_state.invoke_statement().freeze()
+    size = sum(estimate_size(tuple(row)) for row in frozen.data)
+    route = current_route.get()
+    fetched_bytes_total.inc(size, route=route)
+    if size > DB_FETCH_BYTES_WARN:
+        logger.warning("%s fetched ~%d bytes in one statement: %s", route, size, orm_execute_state.statement)
+    return frozen()
+
+if DB_TRACK_FETCH_BYTES:
+    event.listen(Session, "do_orm_execute", track_fetched_bytes)
@@ -0,0 +1,151 @@
+"""
+Near-duplicate posts (reposts, copy-pasted spam), found through the HNSW index.
+
+create_posts probes the DUPLICATE_PROBE_K nearest posts of the new embedding, once, for one
+closer than DUPLICATE_DISTANCE (cosine) that has the same author or was posted in the last
+DUPLICATE_WINDOW_HOURS. DUPLICATE_MODE decides what happens to a match:
+- flag: the post is stored with duplicate_of set to the original and kept out of the feeds
+- reject: 409
+- merge: reposting your own post returns that post instead of storing a new one
+  (a match by another author is flagged)
+- off: no probe
+
+Posts stored without the probe (bulk creation, rows from before this check) get a row in
+PostDuplicatesPending, and the scheduler clusters them in batches with the same rule: each
+duplicate points at the oldest post of its cluster. Like the neighbour flags, the queue is
+its own table: taking and clearing it never locks or rewrites the posts rows.
+"""
+import os
+from typing import NamedTuple
+from sqlalchemy import text, bindparam
+from sqlalchemy.ext.asyncio import AsyncSession
+from pgvector.sqlalchemy import Vector
+from dotenv import load_dotenv
+from app.db import async_session_factory
+from app.instrumentation import timed_task
+
+load_dotenv()
+
+DUPLICATE_MODE = os.getenv("DUPLICATE_MODE", "flag").lower()
+# Cosine distance, 0.05 = 0.95 similarity
+DUPLICATE_DISTANCE = float(os.getenv("DUPLICATE_DISTANCE", "0.05"))
+DUPLICATE_WINDOW_HOURS = int(os.getenv("DUPLICATE_WINDOW_HOURS", "24"))
+DUPLICATE_PROBE_K = int(os.getenv("DUPLICATE_PROBE_K", "10"))
+DUPLICATE_REFRESH_SECONDS = int(os.getenv("DUPLICATE_REFRESH_SECONDS", "300"))
+DUPLICATE_BATCH_SIZE = int(os.getenv("DUPLICATE_BATCH_SIZE", "200"))
+DUPLICATE_MAX_PER_RUN = int(os.getenv("DUPLICATE_MAX_PER_RUN", "10000"))
+
+if DUPLICATE_MODE not in ("off", "flag", "reject", "merge"):
+    raise ValueError(f"DUPLICATE_MODE must be off, flag, reject or merge, not {DUPLICATE_MODE!r}")
+
+
+class Duplicate(NamedTuple):
+    id: int
+    root: int           # oldest post of the cluster, what duplicate_of points at
+    same_author: bool
+
+
+# The K nearest by the index first, the author/window rule on those K only: the probe costs
+# one bounded index scan whatever the filter matches
+_probe = text("""
+    SELECT id, coalesce(duplicate_of, id) AS root, author_id = :author_id AS same_author
+    FROM (
+        SELECT id, author_id, created_at, duplicate_of, embedding <=> :embedding AS distance
+        FROM posts WHERE embedding IS NOT NULL
+        ORDER BY embedding <=> :embedding
+        LIMIT :k
+    ) AS nearest
+    WHERE distance < :distance
+      AND (author_id = :author_id OR created_at > now() - make_interval(hours => :hours))
+    ORDER BY author_id = :author_id DESC, distance
+    LIMIT 1
+""").bindparams(bindparam("embedding", type_=Vector(384)))
+
+# Same probe per post of the batch, only older posts can be the original
+_cluster = text("""
+    UPDATE posts SET duplicate_of = found.root
+    FROM (
+        SELECT src.id, nearest.root FROM posts AS src
+        JOIN LATERAL (
+            SELECT coalesce(candidate.duplicate_of, candidate.id) AS root
+            FROM (
+                SELECT p.id, p.author_id, p.created_at, p.duplicate_of, p.embedding <=> src.embedding AS distance
+                FROM posts AS p
+                WHERE p.id != src.id AND p.embedding IS NOT NULL
+                ORDER BY p.embedding <=> src.embedding
+                LIMIT :k
+            ) AS candidate
+            WHERE candidate.distance < :distance AND candidate.id < src.id
+              AND (candidate.author_id = src.author_id
+                   OR candidate.created_at > src.created_at - make_interval(hours => :hours))
+            ORDER BY candidate.id
+            LIMIT 1
+        ) AS nearest ON true
+        WHERE src.id = ANY(:ids) AND src.embedding IS NOT NULL
+    ) AS found
+    WHERE posts.id = found.id
+""")
+
+# A post matched against one of the same batch points at it, not at its root yet
+_flatten = text("""
+    UPDATE posts SET duplicate_of = original.duplicate_of
+    FROM posts AS original
+    WHERE posts.id = ANY(:ids) AND posts.duplicate_of = original.id AND original.duplicate_of IS NOT NULL
+""")
+
+
+async def find_duplicate(session: AsyncSession, author_id: int, embedding: list[float]) -> Duplicate | None:
+    if DUPLICATE_MODE == "off":
+        return None
+    result = await session.execute(_probe, {
+        "embedding": embedding, "author_id": author_id, "k": DUPLICATE_PROBE_K,
+        "distance": DUPLICATE_DISTANCE, "hours": DUPLICATE_WINDOW_HOURS,
+    })
+    row = result.first()
+    return Duplicate(*row) if row is not None else None
+
+_reroot = text("""
+    WITH heir AS (SELECT min(id) AS id FROM posts WHERE duplicate_of = :id)
+    UPDATE posts SET duplicate_of = CASE WHEN posts.id = heir.id THEN NULL ELSE heir.id END
+    FROM heir
+    WHERE posts.duplicate_of = :id
+""")
+
+async def flag_posts(session: AsyncSession, post_ids: list[int]):
+    """Queues post_ids for cluster_duplicates (stored without the probe). No commit."""
+    await session.execute(
+        text("INSERT INTO postduplicatespending (post_id) SELECT unnest(CAST(:ids AS integer[])) AS id ORDER BY id "
+             "ON CONFLICT DO NOTHING"),
+        {"ids": sorted(post_ids)}
+    )
+
+async def reroot_cluster(session: AsyncSession, post_id: int):
+    """
+    Before a post is deleted: if it is a cluster's root, the oldest duplicate becomes the root
+    and the others point at it (ON DELETE SET NULL alone would put them all back in the feeds). No commit.
+    """
+    await session.execute(_reroot, {"id": post_id})
+
+@timed_task
+async def cluster_duplicates():
+    """Scheduler job, SKIP LOCKED like refresh_stale_neighbors so every worker can run it."""
+    if DUPLICATE_MODE == "off":
+        return
+    done = 0
+    while done < DUPLICATE_MAX_PER_RUN:
+        async with async_session_factory() as session:
+            # Locks queue rows only, the posts themselves stay free for votes and edits
+            result = await session.execute(
+                text("SELECT post_id FROM postduplicatespending "
+                     "ORDER BY post_id LIMIT :batch FOR UPDATE SKIP LOCKED"),
+                {"batch": DUPLICATE_BATCH_SIZE}
+            )
+            post_ids = result.scalars().all()
+            if not post_ids:
+                return
+            params = {"ids": post_ids, "k": DUPLICATE_PROBE_K, "distance": DUPLICATE_DISTANCE, "hours": DUPLICATE_WINDOW_HOURS}
+            await session.execute(_cluster, params)
+            await session.execute(_flatten, {"ids": post_ids})
+            await session.execute(text("DELETE FROM postduplicatespending WHERE post_id = ANY(:ids)"), {"ids": post_ids})
+            await session.commit()
+        done += len(post_ids)
@@ -0,0 +1,136 @@
+import functools
+import time
+from contextvars import ContextVar
+from sqlalchemy import event
+from app import metrics
+from app.db import engine, read_replicas
+
+request_duration_seconds = metrics.Histogram(
+    "http_request_duration_seconds", "Time until the last response byte was sent", ("route", "method", "status")
+)
+request_db_statements = metrics.Histogram(
+    "http_request_db_statements", "SQL statements executed per request", ("route",),
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50, 100),
+)
+request_db_seconds = metrics.Histogram(
+    "http_request_db_seconds", "Time spent executing SQL per request", ("route",)
+)
+executor_wait_seconds = metrics.Histogram(
+    "executor_queue_wait_seconds", "Time a blocking call waited for an executor thread", ("task",)
+)
+executor_run_seconds = metrics.Histogram(
+    "executor_run_seconds", "Time a blocking call ran in the executor (inference, hashing)", ("task",)
+)
+background_task_seconds = metrics.Histogram(
+    "background_task_duration_seconds", "Duration of background and scheduled tasks", ("task",)
+)
+background_task_failures_total = metrics.Counter(
+    "background_task_failures_total", "Background and scheduled tasks that raised", ("task",)
+)
+
+
+class RequestStats:
+    __slots__ = ("statements", "db_seconds")
+
+    def __init__(self):
+        self.statements = 0
+        self.db_seconds = 0.0
+
+# Set by MetricsMiddleware; tasks spawned by the request (cache loads, single-flight) inherit it
+request_stats: ContextVar[RequestStats | None] = ContextVar("request_stats", default=None)
+
+
+# A connection runs one statement at a time, so a single start mark per connection is enough
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info["query_start"] = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info.pop("query_start", None)
+    stats = request_stats.get()
+    if stats is not None and start is not None:
+        elapsed = time.perf_counter() - start
+        stats.statements += 1
+        stats.db_seconds += elapsed
+
+for _engine in [engine] + [replica.engine for replica in read_replicas]:
+    event.listen(_engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(_engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+
+
+class MetricsMiddleware:
+    """
+    Plain ASGI middleware (no BaseHTTPMiddleware overhead). Latency and SQL numbers are taken
+    when the last body chunk goes out, so BackgroundTasks running afterwards don't count.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        start = time.perf_counter()
+        status_code = 500
+        recorded = False
+
+        def record():
+            nonlocal recorded
+            recorded = True
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            request_duration_seconds.observe(
+                time.perf_counter() - start, route=path, method=scope["method"], status=status_code
+            )
+            request_db_statements.observe(stats.statements, route=path)
+            request_db_seconds.observe(stats.db_seconds, route=path)
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            elif message["type"] == "http.response.body" and not message.get("more_body", False) and not recorded:
+                record()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if not recorded:
+                record()
+            request_stats.reset(token)
+
+
+def timed_call(func, *args):
+    """Wraps a blocking call for the executor, measuring its queue wait and run time."""
+    submitted = time.perf_counter()
+    name = getattr(func, "__name__", "call")
+
+    def run():
+        started = time.perf_counter()
+        executor_wait_seconds.observe(started - submitted, task=name)
+        try:
+            return func(*args)
+        finally:
+            executor_run_seconds.observe(time.perf_counter() - started, task=name)
+
+    return run
+
+def timed_task(func):
+    """Decorator for background / scheduled coroutines: duration and failures per task name."""
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            background_task_failures_total.inc(task=func.__name__)
+            raise
+        finally:
+            background_task_seconds.observe(time.perf_counter() - start, task=func.__name__)
+
+    return wrapper
@@ -0,0 +1,193 @@
+"""
+Live comment deltas for GET /comments/{post_id}/stream (Server-Sent Events).
+
+Comment writes call publish_comment() inside their transaction: Postgres builds the
+Comment_out JSON of the row and pg_notify()s it on channel comments_<post_id>, delivered
+only if the transaction commits. Each worker holds one asyncpg connection that LISTENs to
+the channels of the posts it has viewers for, opened with the first viewer. A post's
+channel is LISTENed while it has subscribers and UNLISTENed with the last one, so idle
+posts cost nothing, and a notification is formatted once and shared by every viewer's queue.
+
+The same connection carries worker-wide channels (listen), e.g. post cache
+invalidations: those stay LISTENed for the worker's lifetime and are re-LISTENed on a new
+connection if it drops.
+"""
+import asyncio
+import logging
+import os
+import asyncpg
+from sqlalchemy import text, make_url
+from sqlalchemy.ext.asyncio import AsyncSession
+from dotenv import load_dotenv
+from app import metrics
+from app.db import DATABASE_URL
+
+load_dotenv()
+
+# Seconds between attempts to get the LISTEN connection back for the worker-wide channels
+LIVE_RECONNECT_SECONDS = float(os.getenv("LIVE_RECONNECT_SECONDS", "5"))
+# Events buffered per viewer; a viewer that falls this far behind is disconnected and reconnects
+LIVE_QUEUE_SIZE = int(os.getenv("LIVE_QUEUE_SIZE", "100"))
+LIVE_HEARTBEAT_SECONDS = float(os.getenv("LIVE_HEARTBEAT_SECONDS", "15"))
+
+live_subscribers = metrics.Counter(
+    "live_comment_subscriptions_total", "SSE comment stream subscriptions opened", ()
+)
+live_dropped = metrics.Counter(
+    "live_comment_dropped_total", "SSE viewers disconnected because their queue was full", ()
+)
+
+logger = logging.getLogger(__name__)
+
+# Sent to a viewer whose stream can't continue (queue overflow, LISTEN connection lost):
+# the client reconnects and reloads the page with GET /comments/{post_id}
+RESET = b"event: reset\ndata: {}\n\n"
+HEARTBEAT = b": ping\n\n"
+
+_publish = text("""
+    SELECT pg_notify('comments_' || c.post_id, json_build_object(
+        'event', CAST(:event AS text),
+        'comment', json_build_object(
+            'id', c.id, 'content', c.content, 'created_at', c.created_at, 'modified_at', c.modified_at,
+            'user_id', c.user_id, 'post_id', c.post_id, 'parent_id', c.parent_id, 'is_deleted', c.is_deleted,
+            'author', json_build_object('id', u.id, 'username', u.username), 'votes', c.votes
+        )
+    )::text)
+    FROM comments AS c JOIN users AS u ON u.id = c.user_id
+    WHERE c.id = :id
+""")
+
+async def publish_comment(session: AsyncSession, comment_id: int, event: str):
+    """Queues the comment's current state for viewers of its post; sent on commit. No commit."""
+    await session.flush()
+    result = await session.execute(_publish, {"id": comment_id, "event": event})
+    if result.first() is None:
+        # No row, no notification: viewers would silently miss this change
+        logger.error("live comment %r event for comment id %r matched no row, nothing published", event, comment_id)
+
+
+def _channel(post_id: int) -> str:
+    return f"comments_{post_id}"
+
+class CommentHub:
+    """Per-worker LISTEN connection, post_id -> subscriber queues, and worker-wide channels."""
+
+    def __init__(self):
+        self._connection: asyncpg.Connection | None = None
+        self._lock = asyncio.Lock()
+        self._subscribers: dict[int, set[asyncio.Queue]] = {}
+        # channel -> callback(payload), payload None when notifications may have been missed
+        self._channels: dict = {}
+        self._reconnecting: asyncio.Task | None = None
+
+    async def _connect(self) -> asyncpg.Connection:
+        if self._connection is None or self._connection.is_closed():
+            url = make_url(DATABASE_URL).set(drivername="postgresql").render_as_string(hide_password=False)
+            connection = await asyncpg.connect(url)
+            for channel in self._channels:
+                await connection.add_listener(channel, self._on_channel)
+            connection.add_termination_listener(self._on_terminated)
+            self._connection = connection
+        return self._connection
+
+    async def listen(self, channel: str, callback):
+        """Calls callback(payload) for every notification on channel, for the worker's lifetime."""
+        async with self._lock:
+            connection = await self._connect()
+            if channel not in self._channels:
+                self._channels[channel] = callback
+                await connection.add_listener(channel, self._on_channel)
+
+    def _on_channel(self, connection, pid, channel: str, payload: str):
+        self._channels[channel](payload)
+
+    def _on_notification(self, connection, pid, channel: str, payload: str):
+        message = b"event: comment\ndata: " + payload.encode() + b"\n\n"
+        post_id = int(channel.rsplit("_", 1)[1])
+        for queue in list(self._subscribers.get(post_id, ())):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                live_dropped.inc()
+                self._reset(queue)
+
+    def _on_terminated(self, connection):
+        logger.warning("LISTEN connection for live comments lost, resetting %d streams", len(self._subscribers))
+        self._connection = None
+        # Every stream ends, the next subscriber LISTENs again on a new connection
+        for queues in self._subscribers.values():
+            for queue in queues:
+                self._reset(queue)
+        self._subscribers.clear()
+        if self._channels:
+            for callback in self._channels.values():
+                callback(None)
+            if self._reconnecting is None or self._reconnecting.done():
+                self._reconnecting = asyncio.ensure_future(self._reconnect())
+
+    async def _reconnect(self):
+        while True:
+            try:
+                async with self._lock:
+                    await self._connect()
+                # Notifications sent while reconnecting are lost: tell the callbacks again once back
+                for callback in self._channels.values():
+                    callback(None)
+                return
+            except (OSError, asyncpg.PostgresError) as e:
+                logger.warning("LISTEN connection not back yet (%s), retrying in %ss", e, LIVE_RECONNECT_SECONDS)
+                await asyncio.sleep(LIVE_RECONNECT_SECONDS)
+
+    def _reset(self, queue: asyncio.Queue):
+        # Make room for RESET so the viewer's stream ends right away
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(RESET)
+
+    async def subscribe(self, post_id: int) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=LIVE_QUEUE_SIZE)
+        async with self._lock:
+            connection = await self._connect()
+            if post_id not in self._subscribers:
+                await connection.add_listener(_channel(post_id), self._on_notification)
+                self._subscribers[post_id] = set()
+            self._subscribers[post_id].add(queue)
+        live_subscribers.inc()
+        return queue
+
+    async def unsubscribe(self, post_id: int, queue: asyncio.Queue):
+        async with self._lock:
+            queues = self._subscribers.get(post_id)
+            if queues is None:
+                return
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[post_id]
+                if self._connection is not None and not self._connection.is_closed():
+                    await self._connection.remove_listener(_channel(post_id), self._on_notification)
+
+    async def stream(self, post_id: int):
+        """SSE body for one viewer: comment events, heartbeats, and a final reset if it can't keep up."""
+        queue = await self.subscribe(post_id)
+        try:
+            yield b"retry: 3000\n\n"
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), LIVE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    message = HEARTBEAT
+                yield message
+                if message is RESET:
+                    return
+        finally:
+            await self.unsubscribe(post_id, queue)
+
+    async def close(self):
+        if self._reconnecting is not None:
+            self._reconnecting.cancel()
+        if self._connection is not None and not self._connection.is_closed():
+            self._connection.remove_termination_listener(self._on_terminated)
+            await self._connection.close()
+
+
+comment_hub = CommentHub()
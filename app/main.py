@@ -1,13 +1,22 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Depends
 from contextlib import asynccontextmanager
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from sqlmodel import SQLModel
 from typing import List
-from app.db import engine, initialize_vector_extension
+from app.db import engine, initialize_vector_extension, DB_TRACK_FETCH_BYTES, ReadYourWritesMiddleware
 import app.utils as utils
+from app.neighbors import refresh_stale_neighbors, NEIGHBORS_REFRESH_SECONDS
+from app.trending import refresh_trending, cleanup_vote_buckets, TRENDING_REFRESH_SECONDS
+from app.duplicates import cluster_duplicates, DUPLICATE_REFRESH_SECONDS
+from app.stats import reconcile_stats, STATS_RECONCILE_SECONDS
+from datetime import datetime
+from app.live import comment_hub
+from app.cache import on_post_invalidated, POST_CACHE_CHANNEL
+from app.instrumentation import MetricsMiddleware
+from app.profiler import ProfilerMiddleware
 # import app.model as model
 # import app.schemas as schemas
-from routers import post_route, auth_route, vote_route, comment_route, feed_route
+from routers import post_route, auth_route, vote_route, comment_route, feed_route, admin_route, search_route, user_route
 
 scheduler = AsyncIOScheduler()
 
@@ -17,20 +26,38 @@ async def lifespan(app: FastAPI):
         await initialize_vector_extension(engine)
         await conn.run_sync(SQLModel.metadata.create_all)
     # Startup
+    await comment_hub.listen(POST_CACHE_CHANNEL, on_post_invalidated)
     scheduler.add_job(utils.cleanup_revoked_tokens, "interval", hours=24, id="cleanup_revoked")
     scheduler.add_job(utils.cleanup_expired_tokens, "interval", hours=24, id="cleanup_expired")
+    scheduler.add_job(refresh_stale_neighbors, "interval", seconds=NEIGHBORS_REFRESH_SECONDS, id="refresh_neighbors",
+                      max_instances=1, coalesce=True)
+    scheduler.add_job(refresh_trending, "interval", seconds=TRENDING_REFRESH_SECONDS, id="refresh_trending",
+                      max_instances=1, coalesce=True, next_run_time=datetime.now())
+    scheduler.add_job(cleanup_vote_buckets, "interval", minutes=10, id="cleanup_vote_buckets")
+    scheduler.add_job(cluster_duplicates, "interval", seconds=DUPLICATE_REFRESH_SECONDS, id="cluster_duplicates",
+                      max_instances=1, coalesce=True)
+    scheduler.add_job(reconcile_stats, "interval", seconds=STATS_RECONCILE_SECONDS, id="reconcile_stats",
+                      max_instances=1, coalesce=True)
     scheduler.start()
     yield
     # Shutdown
     scheduler.shutdown()
+    await comment_hub.close()
     engine.dispose()
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, dependencies=[Depends(utils.track_route)] if DB_TRACK_FETCH_BYTES else None)
 
 app.include_router(post_route.router)
 app.include_router(auth_route.router)
 app.include_router(vote_route.router)
 app.include_router(comment_route.router)
 app.include_router(feed_route.router)
+app.include_router(admin_route.router)
+app.include_router(search_route.router)
+app.include_router(user_route.router)
+
+app.add_middleware(ReadYourWritesMiddleware)
+app.add_middleware(ProfilerMiddleware)
+app.add_middleware(MetricsMiddleware)
 
     
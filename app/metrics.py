@@ -0,0 +1,86 @@
+from bisect import bisect_left
+
+
+class Counter:
+    """Monotonic counter, optionally split by label values (Prometheus style)."""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple, float] = {}
+        registry.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(tuple(labels.get(name, "") for name in self.labelnames), 0)
+
+
+class Histogram:
+    """Bucketed histogram (Prometheus style); values in seconds unless the name says otherwise."""
+
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts..., +Inf count, sum]
+        self._values: dict[tuple, list] = {}
+        registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        series = self._values.get(key)
+        if series is None:
+            series = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        # first bucket whose upper bound is >= value, len(buckets) is +Inf
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def count(self, **labels) -> int:
+        series = self._values.get(tuple(labels.get(name, "") for name in self.labelnames))
+        return sum(series[:-1]) if series else 0
+
+    def sum(self, **labels) -> float:
+        series = self._values.get(tuple(labels.get(name, "") for name in self.labelnames))
+        return series[-1] if series else 0.0
+
+
+registry: list = []
+
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(labelnames: tuple, values: tuple, **extra) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra.items()]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def render() -> str:
+    """Every registered metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        if isinstance(metric, Histogram):
+            lines.append(f"# TYPE {metric.name} histogram")
+            for values, series in list(metric._values.items()):
+                cumulative = 0
+                for bound, count in zip(metric.buckets, series):
+                    cumulative += count
+                    lines.append(f"{metric.name}_bucket{_labels(metric.labelnames, values, le=bound)} {cumulative}")
+                cumulative += series[len(metric.buckets)]
+                lines.append(f"{metric.name}_bucket{_labels(metric.labelnames, values, le='+Inf')} {cumulative}")
+                lines.append(f"{metric.name}_sum{_labels(metric.labelnames, values)} {series[-1]}")
+                lines.append(f"{metric.name}_count{_labels(metric.labelnames, values)} {cumulative}")
+        else:
+            lines.append(f"# TYPE {metric.name} counter")
+            for values, value in list(metric._values.items()):
+                lines.append(f"{metric.name}{_labels(metric.labelnames, values)} {value}")
+    return "\n".join(lines) + "\n"
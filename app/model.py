@@ -1,10 +1,17 @@
-from sqlmodel import Field, SQLModel, Index, SmallInteger, CheckConstraint, Relationship, UniqueConstraint
+from sqlmodel import Field, SQLModel, Index, SmallInteger, CheckConstraint, Relationship
 from datetime import datetime
-from sqlalchemy import func, Column, DateTime
+from sqlalchemy import func, Column, DateTime, text, event
+from sqlalchemy.orm import deferred
 from pgvector.sqlalchemy import Vector
 from pydantic import EmailStr
 from typing import Optional
 
+# Embeddings are 384 floats that only search, the personalized feed and the EMA update read.
+# They are deferred: plain entity loads skip them, select(Posts.embedding) or
+# .options(undefer(Posts.embedding)) fetch them where they are actually needed.
+posts_embedding_column = Column("embedding", Vector(384), nullable=True)
+users_embedding_column = Column("embedding", Vector(384), nullable=True)
+
 
 class Posts(SQLModel, table=True):
     id: int | None = Field(default=None, primary_key=True) 
@@ -31,9 +38,13 @@ class Posts(SQLModel, table=True):
     )
     embedding: list[float] | None = Field(
         default=None,
-        sa_column=Column(Vector(384), nullable=True)
+        sa_column=posts_embedding_column
     )
+    # Near-duplicate of this post (oldest of its cluster), kept out of the feeds (app.duplicates)
+    duplicate_of: Optional[int] = Field(default=None, foreign_key="posts.id", ondelete="SET NULL", index=True)
     
+    __mapper_args__ = {"properties": {"embedding": deferred(posts_embedding_column)}}
+
     __table_args__ = (
         Index(
             "posts_embedding_idx",        # Name of the index
@@ -44,6 +55,7 @@ class Posts(SQLModel, table=True):
             },
         ),
         Index("ix_posts_author_created", "author_id", "created_at"),
+        Index("ix_posts_title_trgm", "title", postgresql_using="gin", postgresql_ops={"title": "gin_trgm_ops"}),
     )
 
     # The Python-side link back to the user
@@ -65,23 +77,46 @@ class Users(SQLModel, table=True):
 
     embedding: list[float] | None = Field(
         default=None,
-        sa_column=Column(Vector(384), nullable=True)
+        sa_column=users_embedding_column
     )
 
+    __mapper_args__ = {"properties": {"embedding": deferred(users_embedding_column)}}
+
     # The Python-side link back to the posts
     posts: list["Posts"] = Relationship(back_populates="author")
     comments: list["Comments"] = Relationship(back_populates="author")
 
     __table_args__ = (
         CheckConstraint("super_vote_balance >= 0", name="check_super_vote_positive"),
+        Index("ix_users_username_trgm", "username", postgresql_using="gin", postgresql_ops={"username": "gin_trgm_ops"}),
     )
 
     
-class Votes(SQLModel, table=True):
-    id: Optional[int] = Field(default=None, primary_key=True)
-    user_id: int = Field(foreign_key="users.id")
-    post_id: Optional[int] = Field(default=None, nullable=True, foreign_key="posts.id", ondelete="CASCADE")
-    comment_id: Optional[int] = Field(default=None, nullable=True, foreign_key="comments.id", ondelete="CASCADE")
+# Votes live in two tables, hash-partitioned on the target id: the vote lookup, the cascade
+# when a post or comment is deleted, and per-target aggregates all hit one partition, through
+# a primary key that leads with the target id. The (user_id, ...) INCLUDE indexes answer
+# per-user reads (export, "did I vote") with index-only scans.
+# The partition count is fixed at creation; changing it means rewriting the table.
+VOTE_PARTITIONS = 16
+
+class PostVotes(SQLModel, table=True):
+    post_id: int = Field(foreign_key="posts.id", ondelete="CASCADE", primary_key=True)
+    user_id: int = Field(foreign_key="users.id", primary_key=True)
+    direction: int = Field(sa_type=SmallInteger)
+    is_super: bool = Field(default=False)
+    created_at : datetime = Field(
+                sa_column=Column(DateTime(timezone=True),
+                server_default=func.now(),
+                nullable=False))
+
+    __table_args__ = (
+        Index("ix_postvotes_user", "user_id", "post_id", postgresql_include=["direction", "is_super", "created_at"]),
+        {"postgresql_partition_by": "HASH (post_id)"},
+    )
+
+class CommentVotes(SQLModel, table=True):
+    comment_id: int = Field(foreign_key="comments.id", ondelete="CASCADE", primary_key=True)
+    user_id: int = Field(foreign_key="users.id", primary_key=True)
     direction: int = Field(sa_type=SmallInteger)
     is_super: bool = Field(default=False)
     created_at : datetime = Field(
@@ -90,9 +125,23 @@ class Votes(SQLModel, table=True):
                 nullable=False))
 
     __table_args__ = (
-        UniqueConstraint("user_id", "post_id", name="unique_user_post_vote"),
-        UniqueConstraint("user_id", "comment_id", name="unique_user_comment_vote"),
+        Index("ix_commentvotes_user", "user_id", "comment_id", postgresql_include=["direction", "is_super", "created_at"]),
+        {"postgresql_partition_by": "HASH (comment_id)"},
     )
+
+def vote_partitions_ddl(table) -> list[str]:
+    return [
+        f"CREATE TABLE IF NOT EXISTS {table.name}_p{remainder} PARTITION OF {table.name} "
+        f"FOR VALUES WITH (MODULUS {VOTE_PARTITIONS}, REMAINDER {remainder})"
+        for remainder in range(VOTE_PARTITIONS)
+    ]
+
+def create_vote_partitions(table, connection, **kw):
+    for statement in vote_partitions_ddl(table):
+        connection.execute(text(statement))
+
+event.listen(PostVotes.__table__, "after_create", create_vote_partitions)
+event.listen(CommentVotes.__table__, "after_create", create_vote_partitions)
     
 class RefreshTokens(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
@@ -109,6 +158,41 @@ class RefreshTokens(SQLModel, table=True):
                 server_default=func.now(),
                 nullable=False))
 
+class UserStats(SQLModel, table=True):
+    """Per-user rollup behind GET /users/{id}/profile, kept up to date by the write handlers (app.stats)"""
+    user_id: int = Field(foreign_key="users.id", ondelete="CASCADE", primary_key=True)
+    post_count: int = Field(default=0)
+    comment_count: int = Field(default=0)    # comments not deleted
+    post_karma: int = Field(default=0)       # sum of Posts.votes
+    comment_karma: int = Field(default=0)    # sum of Comments.votes
+
+class PostVoteBuckets(SQLModel, table=True):
+    """Net vote change per post per minute, written in the vote transaction. Feeds /feed/trending"""
+    post_id: int = Field(foreign_key="posts.id", ondelete="CASCADE", primary_key=True)
+    bucket_start: datetime = Field(sa_column=Column(DateTime(timezone=True), primary_key=True, index=True))
+    votes: int = Field(default=0)
+
+class PostNeighbors(SQLModel, table=True):
+    """Precomputed top-K most similar posts of a post, read by GET /posts/{id}/related"""
+    post_id: int = Field(foreign_key="posts.id", ondelete="CASCADE", primary_key=True)
+    rank: int = Field(sa_type=SmallInteger, primary_key=True)
+    neighbor_id: int = Field(foreign_key="posts.id", ondelete="CASCADE", index=True)
+    distance: float
+
+class PostNeighborsStale(SQLModel, table=True):
+    """
+    Posts whose PostNeighbors rows need recomputing (new post, new embedding, a closer post
+    appeared). A table of its own: flagging never touches the posts row or its indexes.
+    """
+    post_id: int = Field(foreign_key="posts.id", ondelete="CASCADE", primary_key=True)
+
+class PostDuplicatesPending(SQLModel, table=True):
+    """
+    Posts not probed for duplicates yet (bulk-created, seeded, created with DUPLICATE_MODE=off),
+    left to the scheduler. Same reason as PostNeighborsStale: the posts row is never touched.
+    """
+    post_id: int = Field(foreign_key="posts.id", ondelete="CASCADE", primary_key=True)
+
 class Comments(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     content: str = Field(max_length=500)
@@ -0,0 +1,119 @@
+"""
+Related posts: a stored top-K neighbour list per post (PostNeighbors) instead of an HNSW
+search on every view.
+
+A post's list is computed when its embedding is written, and again by the scheduler
+whenever it is flagged (a row in PostNeighborsStale). Flags are raised incrementally: when a
+post's list is (re)computed, every neighbour it found that is closer than that neighbour's
+own K-th entry, and does not list the post yet, is flagged. So only neighbourhoods that a
+new or changed post actually entered get recomputed.
+
+Flags live in their own table so raising and clearing them never updates a posts row (no
+index churn on posts, HNSW included, no lock taken on rows that votes update). Flags are
+inserted in post_id order with ON CONFLICT DO NOTHING, and a batch clears its own flags last:
+two workers never wait on each other in opposite orders.
+"""
+import os
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from dotenv import load_dotenv
+from app.db import async_session_factory
+from app.instrumentation import timed_task
+
+load_dotenv()
+
+RELATED_POSTS_K = int(os.getenv("RELATED_POSTS_K", "10"))
+NEIGHBORS_REFRESH_SECONDS = int(os.getenv("NEIGHBORS_REFRESH_SECONDS", "60"))
+# Stale posts recomputed per statement, and at most per scheduler run
+NEIGHBORS_BATCH_SIZE = int(os.getenv("NEIGHBORS_BATCH_SIZE", "100"))
+NEIGHBORS_MAX_PER_RUN = int(os.getenv("NEIGHBORS_MAX_PER_RUN", "5000"))
+
+# One LATERAL HNSW scan per post of the batch
+_compute = text("""
+    INSERT INTO postneighbors (post_id, rank, neighbor_id, distance)
+    SELECT src.id, nearest.rank, nearest.id, nearest.distance
+    FROM posts AS src
+    JOIN LATERAL (
+        SELECT candidate.id, candidate.distance, row_number() OVER (ORDER BY candidate.distance) AS rank
+        FROM (
+            SELECT p.id, p.embedding <=> src.embedding AS distance
+            FROM posts AS p
+            WHERE p.id != src.id AND p.embedding IS NOT NULL
+            ORDER BY p.embedding <=> src.embedding
+            LIMIT :k
+        ) AS candidate
+    ) AS nearest ON true
+    WHERE src.id = ANY(:ids) AND src.embedding IS NOT NULL
+""")
+
+# A neighbourhood changed if one of our new neighbours now has us closer than its K-th entry
+_flag_entered = text("""
+    INSERT INTO postneighborsstale (post_id)
+    SELECT DISTINCT n.neighbor_id FROM postneighbors AS n
+    WHERE n.post_id = ANY(:ids)
+      AND NOT EXISTS (
+          SELECT 1 FROM postneighbors AS r WHERE r.post_id = n.neighbor_id AND r.neighbor_id = n.post_id
+      )
+      AND n.distance < coalesce((
+          SELECT max(m.distance) FROM postneighbors AS m
+          WHERE m.post_id = n.neighbor_id
+          HAVING count(*) >= :k
+      ), 2)
+    ORDER BY n.neighbor_id
+    ON CONFLICT DO NOTHING
+""")
+
+_flag_listing = text("""
+    INSERT INTO postneighborsstale (post_id)
+    SELECT DISTINCT post_id FROM postneighbors WHERE neighbor_id = :id ORDER BY post_id
+    ON CONFLICT DO NOTHING
+""")
+
+
+async def flag_posts(session: AsyncSession, post_ids: list[int]):
+    """Queues post_ids for the scheduler (posts stored without computing their list). No commit."""
+    await session.execute(
+        text("INSERT INTO postneighborsstale (post_id) SELECT unnest(CAST(:ids AS integer[])) AS id ORDER BY id "
+             "ON CONFLICT DO NOTHING"),
+        {"ids": sorted(post_ids)}
+    )
+
+async def refresh_neighbors(session: AsyncSession, post_ids: list[int]):
+    """Recomputes the neighbour lists of post_ids and flags the neighbourhoods they entered. No commit."""
+    if not post_ids:
+        return
+    await session.execute(text("DELETE FROM postneighbors WHERE post_id = ANY(:ids)"), {"ids": post_ids})
+    await session.execute(_compute, {"ids": post_ids, "k": RELATED_POSTS_K})
+    await session.execute(_flag_entered, {"ids": post_ids, "k": RELATED_POSTS_K})
+    # Last: flags raised above for posts of this batch are already satisfied by _compute
+    await session.execute(text("DELETE FROM postneighborsstale WHERE post_id = ANY(:ids)"), {"ids": post_ids})
+
+async def flag_neighbors_of(session: AsyncSession, post_id: int):
+    """Before a post is deleted or re-embedded: the posts listing it lose (or may lose) an entry. No commit."""
+    await session.execute(_flag_listing, {"id": post_id})
+
+@timed_task
+async def run_background_neighbors(post_id: int):
+    """Runs after create/update: the new embedding gets its list right away, not at the next scheduler run."""
+    async with async_session_factory() as session:
+        await refresh_neighbors(session, [post_id])
+        await session.commit()
+
+@timed_task
+async def refresh_stale_neighbors():
+    """Scheduler job. SKIP LOCKED lets every worker's scheduler run it without doing the same posts twice."""
+    done = 0
+    while done < NEIGHBORS_MAX_PER_RUN:
+        async with async_session_factory() as session:
+            # Locks flag rows only, the posts themselves stay free for votes and edits
+            result = await session.execute(
+                text("SELECT post_id FROM postneighborsstale "
+                     "ORDER BY post_id LIMIT :batch FOR UPDATE SKIP LOCKED"),
+                {"batch": NEIGHBORS_BATCH_SIZE}
+            )
+            post_ids = result.scalars().all()
+            if not post_ids:
+                return
+            await refresh_neighbors(session, post_ids)
+            await session.commit()
+        done += len(post_ids)
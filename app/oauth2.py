@@ -1,8 +1,8 @@
 from fastapi.security import OAuth2PasswordBearer
-from fastapi import status, HTTPException, Depends
+from fastapi import status, HTTPException, Depends, Request
 from datetime import datetime, timedelta, timezone
 from sqlmodel import select
-from sqlalchemy import delete
+from sqlalchemy import delete, lambda_stmt
 from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Annotated
 from app import model
@@ -20,17 +20,22 @@ load_dotenv()
 # openssl rand -hex 32
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = "HS256"
+# Comma separated user ids allowed on the /admin routes
+ADMIN_USER_IDS = {int(id) for id in os.getenv("ADMIN_USER_IDS", "").split(",") if id.strip()}
 
 
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/token", refreshUrl="auth/refresh")
 
 
+# Hot lookups are lambda statements: built and cache-keyed once, only the bound value changes per call
 async def get_user_by_id(id: int, session: AsyncSession) -> model.Users:
-    return await session.get(model.Users, id)
+    statement = lambda_stmt(lambda: select(model.Users).where(model.Users.id == id))
+    result = await session.execute(statement)
+    return result.scalar_one_or_none()
 
 async def get_user_by_username(username: str, session: AsyncSession) -> model.Users:
-    statement = select(model.Users).where(model.Users.username == username)
+    statement = lambda_stmt(lambda: select(model.Users).where(model.Users.username == username))
     result = await session.execute(statement)
     user = result.scalar_one_or_none()
     return user
@@ -45,7 +50,7 @@ async def check_refresh_token(token: str, jti: str, session: AsyncSession) -> mo
         return None
     elif refresh_token.is_revoked:
         return False
-    elif refresh_token and utils.verify_password(token, refresh_token.token_hash):
+    elif refresh_token and await utils.run_in_executor(session, utils.verify_password, token, refresh_token.token_hash):
         return refresh_token
     return None
 
@@ -59,7 +64,7 @@ async def authenticate_user(id: int|str, password: str, session: AsyncSession):
         return False 
     if not user:
         return False 
-    if not utils.verify_password(password, user.password): 
+    if not await utils.run_in_executor(session, utils.verify_password, password, user.password): 
         return False
     return user 
 
@@ -84,7 +89,7 @@ def create_refresh_token(data: dict, expires_delta: timedelta | None = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt, jti
 
-async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], session: Annotated[AsyncSession, Depends(utils.get_db)]):
+async def get_current_user(request: Request, token: Annotated[str, Depends(oauth2_scheme)], session: Annotated[AsyncSession, Depends(utils.get_db)]):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED, 
         detail="Could not valid credentials",
@@ -104,8 +109,46 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], sessio
     user = await get_user_by_id(id, session)
     if user is None:
         raise credentials_exception 
+    # Lets writes pin this user to the primary and get_read_db honour it (read-your-writes)
+    session.info["user_id"] = user.id
+    request.state.user_id = user.id
     return user
 
+async def get_current_reader(current_user: Annotated[model.Users, Depends(get_current_user)], session: Annotated[AsyncSession, Depends(utils.get_db)]):
+    """
+    get_current_user for routes that read through a session of their own (read_session,
+    get_read_db): the lookup's pooled connection goes back right away instead of being held,
+    idle, until the request ends.
+    """
+    await utils.release_connection(session)
+    return current_user
+
+async def get_current_user_id(request: Request, token: Annotated[str, Depends(oauth2_scheme)]) -> int:
+    """
+    get_current_user without the DB lookup: checks the access token only. For hot read
+    routes that don't need the user row (a deleted account keeps access until the token expires).
+    """
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        if payload.get("typ") != "access" or payload.get("sub") is None:
+            raise InvalidTokenError()
+        request.state.user_id = int(payload["sub"])
+        return request.state.user_id
+    except (InvalidTokenError, ValueError):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not valid credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+async def get_current_admin(current_user: Annotated[model.Users, Depends(get_current_user)]):
+    if current_user.id not in ADMIN_USER_IDS:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not authorized"
+        )
+    return current_user
+
 async def verify_refresh_token(token: Annotated[str, Depends(oauth2_scheme)], session: Annotated[AsyncSession, Depends(utils.get_db)]) -> int:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED, 
@@ -0,0 +1,213 @@
+"""
+Opt-in statistical profiler for live requests.
+
+While at least one selected request is in flight, a daemon thread samples the event loop
+thread and the executor threads every PROFILE_INTERVAL seconds with sys._current_frames().
+Loop samples are attributed to the route whose handler (or a coroutine nested in it) is on
+the stack; executor samples (encode_text, password hashing) go under "executor:<function>".
+Stacks are kept in collapsed form per route and per minute, ready for flamegraph tools.
+
+Samples of the loop thread show whatever route is running at that instant, so concurrent
+requests of an active route are sampled alongside the selected one.
+"""
+import hashlib
+import hmac
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from starlette.routing import Match
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Profile one request in N (0 disables random sampling, signed requests are still profiled)
+PROFILE_SAMPLE_RATE = int(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+PROFILE_RETENTION_MINUTES = int(os.getenv("PROFILE_RETENTION_MINUTES", "60"))
+PROFILE_MAX_STACKS = int(os.getenv("PROFILE_MAX_STACKS", "5000"))
+PROFILE_SECRET = (os.getenv("PROFILE_SECRET") or os.getenv("SECRET_KEY") or "").encode()
+PROFILE_HEADER = b"x-profile-token"
+MAX_STACK_DEPTH = 128
+
+# (minute, route) -> Counter of collapsed stacks
+_profiles: dict = defaultdict(Counter)
+_lock = threading.Lock()
+_active: Counter = Counter()
+_wakeup = threading.Event()
+_sampler: threading.Thread | None = None
+_loop_thread_id: int | None = None
+_route_codes: dict = {}
+_request_counter = 0
+
+
+def sign(expires_at: int) -> str:
+    """Token for the X-Profile-Token header, valid until expires_at (unix time)."""
+    signature = hmac.new(PROFILE_SECRET, str(expires_at).encode(), hashlib.sha256).hexdigest()
+    return f"{expires_at}.{signature}"
+
+def verify(token: str) -> bool:
+    expires_at, _, signature = token.partition(".")
+    if not PROFILE_SECRET or not expires_at.isdigit() or int(expires_at) < time.time():
+        return False
+    return hmac.compare_digest(sign(int(expires_at)), token)
+
+
+def _qualname(code) -> str:
+    return getattr(code, "co_qualname", code.co_name)   # co_qualname is 3.11+
+
+def _frame_label(code) -> str:
+    return f"{os.path.basename(code.co_filename)}:{_qualname(code)}"
+
+def _collapse(frame) -> list:
+    stack = []
+    while frame is not None and len(stack) < MAX_STACK_DEPTH:
+        stack.append(frame.f_code)
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+def _route_of(stack) -> str | None:
+    # innermost frame that belongs to a route handler or to a function defined inside one
+    for code in reversed(stack):
+        route = _route_codes.get((code.co_filename, _qualname(code).split(".")[0]))
+        if route is not None:
+            return route
+    return None
+
+# Frames that call the function submitted to the executor: ThreadPoolExecutor's work item,
+# then app.instrumentation.timed_call's wrapper
+_EXECUTOR_RUNNERS = {("thread.py", "_WorkItem.run"), ("instrumentation.py", "timed_call.<locals>.run")}
+
+def _submitted_function(stack: list) -> str:
+    """Name of the function handed to the executor (encode_text), not of the leaf frame sampled inside it."""
+    for depth in range(len(stack) - 2, -1, -1):
+        code = stack[depth]
+        if (os.path.basename(code.co_filename), _qualname(code)) in _EXECUTOR_RUNNERS:
+            return stack[depth + 1].co_name
+    return stack[-1].co_name
+
+def _record(route: str, stack: list, minute: int):
+    collapsed = ";".join(_frame_label(code) for code in stack)
+    with _lock:
+        bucket = _profiles[(minute, route)]
+        if collapsed in bucket or len(bucket) < PROFILE_MAX_STACKS:
+            bucket[collapsed] += 1
+
+def _take_sample():
+    minute = int(time.time() // 60)
+    # the loop's default executor names its threads asyncio_N, a bare ThreadPoolExecutor ThreadPoolExecutor-N_M
+    executor_threads = {t.ident for t in threading.enumerate() if t.name.startswith(("asyncio_", "ThreadPoolExecutor"))}
+    for thread_id, frame in sys._current_frames().items():
+        if thread_id == _loop_thread_id:
+            stack = _collapse(frame)
+            route = _route_of(stack)
+            if route is not None and _active[route]:
+                _record(route, stack, minute)
+        elif thread_id in executor_threads:
+            # an idle worker sits in _worker waiting on its queue
+            if frame.f_code.co_name == "_worker":
+                continue
+            stack = _collapse(frame)
+            _record(f"executor:{_submitted_function(stack)}", stack, minute)
+
+def _evict(now_minute: int):
+    with _lock:
+        for key in [key for key in _profiles if key[0] < now_minute - PROFILE_RETENTION_MINUTES]:
+            del _profiles[key]
+
+def _run_sampler():
+    last_evict = 0
+    while True:
+        _wakeup.wait()
+        while sum(_active.values()) > 0:
+            _take_sample()
+            time.sleep(PROFILE_INTERVAL)
+        now_minute = int(time.time() // 60)
+        if now_minute != last_evict:
+            _evict(now_minute)
+            last_evict = now_minute
+        with _lock:
+            if sum(_active.values()) == 0:
+                _wakeup.clear()
+
+
+def collapsed_stacks(route: str | None, since: float, until: float) -> str:
+    """Merged collapsed stacks ("frame;frame;frame count" lines) for a route (or all) in [since, until]."""
+    merged = Counter()
+    with _lock:
+        for (minute, key_route), stacks in _profiles.items():
+            if since // 60 <= minute <= until // 60 and (route is None or key_route == route):
+                merged.update({f"{key_route};{stack}" if route is None else stack: n for stack, n in stacks.items()})
+    return "".join(f"{stack} {count}\n" for stack, count in merged.most_common())
+
+
+def _flat_routes(routes):
+    # included routers are nested in recent FastAPI versions, flattened in older ones
+    for route in routes:
+        nested = getattr(route, "routes", None) or getattr(getattr(route, "original_router", None), "routes", None)
+        if nested:
+            yield from _flat_routes(nested)
+        elif getattr(route, "path", None) is not None:
+            yield route
+
+def _index_routes(app) -> list:
+    routes = list(_flat_routes(app.routes))
+    for route in routes:
+        endpoint = getattr(route, "endpoint", None)
+        code = getattr(endpoint, "__code__", None)
+        if code is not None:
+            _route_codes[(code.co_filename, endpoint.__qualname__.split(".")[0])] = route.path
+    return routes
+
+def _match_route(routes, scope) -> str | None:
+    for route in routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return None
+
+def _selected(scope) -> bool:
+    global _request_counter
+    for name, value in scope["headers"]:
+        if name == PROFILE_HEADER:
+            return verify(value.decode("latin-1"))
+    if PROFILE_SAMPLE_RATE > 0:
+        _request_counter += 1
+        return _request_counter % PROFILE_SAMPLE_RATE == 0
+    return False
+
+
+class ProfilerMiddleware:
+    """Selects 1-in-PROFILE_SAMPLE_RATE requests, or ones with a valid X-Profile-Token, for sampling."""
+
+    def __init__(self, app):
+        self.app = app
+        self.routes = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not _selected(scope):
+            await self.app(scope, receive, send)
+            return
+
+        global _sampler, _loop_thread_id
+        if _sampler is None:
+            _loop_thread_id = threading.get_ident()
+            _sampler = threading.Thread(target=_run_sampler, name="request-profiler", daemon=True)
+            _sampler.start()
+
+        if self.routes is None:
+            self.routes = _index_routes(scope["app"])
+        route = _match_route(self.routes, scope)
+        if route is None:
+            await self.app(scope, receive, send)
+            return
+        with _lock:
+            _active[route] += 1
+        _wakeup.set()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            with _lock:
+                _active[route] -= 1
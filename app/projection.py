@@ -0,0 +1,103 @@
+"""
+ORM-free read path for list endpoints.
+
+Selects only the Post_out / Comment_out columns plus the author username as plain rows,
+packs them into slotted dataclasses and serializes them straight to bytes. The field
+order and datetime format match what FastAPI produces through response_model, so the
+bytes on the wire are the same.
+"""
+import json
+from dataclasses import dataclass, asdict, is_dataclass
+from datetime import datetime
+from sqlmodel import select
+from app import model
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional, json gives identical output
+    orjson = None
+
+
+@dataclass(slots=True)
+class AuthorRow:
+    id: int
+    username: str
+
+@dataclass(slots=True)
+class PostRow:
+    title: str
+    content: str
+    published: bool
+    id: int
+    author_id: int
+    author: AuthorRow
+    votes: int
+    comments_count: int
+    created_at: datetime
+
+@dataclass(slots=True)
+class CommentRow:
+    id: int
+    content: str
+    created_at: datetime
+    modified_at: datetime | None
+    user_id: int
+    post_id: int
+    parent_id: int | None
+    is_deleted: bool
+    author: AuthorRow
+    votes: int
+
+
+POST_COLUMNS = (
+    model.Posts.title, model.Posts.content, model.Posts.published, model.Posts.id,
+    model.Posts.author_id, model.Posts.votes, model.Posts.comments_count, model.Posts.created_at,
+    model.Users.username,
+)
+
+COMMENT_COLUMNS = (
+    model.Comments.id, model.Comments.content, model.Comments.created_at, model.Comments.modified_at,
+    model.Comments.user_id, model.Comments.post_id, model.Comments.parent_id, model.Comments.is_deleted,
+    model.Comments.votes, model.Users.username,
+)
+
+def select_posts(*extra):
+    """select() of the Post_out columns with the author joined. Extra columns come after them."""
+    return select(*POST_COLUMNS, *extra).join(model.Users, model.Users.id == model.Posts.author_id)
+
+def select_comments(*extra):
+    return select(*COMMENT_COLUMNS, *extra).join(model.Users, model.Users.id == model.Comments.user_id)
+
+def to_post(row) -> PostRow:
+    return PostRow(row[0], row[1], row[2], row[3], row[4], AuthorRow(row[4], row[8]), row[5], row[6], row[7])
+
+def to_comment(row) -> CommentRow:
+    return CommentRow(row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7], AuthorRow(row[4], row[9]), row[8])
+
+
+def _isoformat(value: datetime) -> str:
+    # pydantic writes UTC as "Z"
+    text = value.isoformat()
+    return text[:-6] + "Z" if text.endswith("+00:00") else text
+
+def _default(value):
+    if isinstance(value, datetime):
+        return _isoformat(value)
+    if is_dataclass(value):
+        return asdict(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dumps(value) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_UTC_Z)
+    return json.dumps(value, default=_default, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+async def fetch_posts(session, statement) -> bytes:
+    """Runs a select_posts() statement and returns the serialized List[Post_out]."""
+    result = await session.execute(statement)
+    return dumps([to_post(row) for row in result])
+
+async def fetch_comments(session, statement) -> bytes:
+    result = await session.execute(statement)
+    return dumps([to_comment(row) for row in result])
@@ -0,0 +1,175 @@
+"""
+Token-bucket rate limiting as route dependencies, checked before anything touches the DB.
+
+    @router.post("/{post_id}", dependencies=[Depends(ratelimit.votes)])
+
+Decorator dependencies run before the endpoint's own (get_current_user, get_db), so a
+rejected request costs a dict lookup: no session, no query, no Argon2. Buckets are keyed by
+the user id of a valid access token, else by client IP. Limits are "<requests>/<seconds>"
+strings from the environment; the bucket holds that many requests and refills continuously.
+
+Buckets live in the worker's memory unless RATE_LIMIT_REDIS_URL is set, in which case every
+worker shares them through Redis (redis package required). Full buckets are evicted, they
+hold nothing a fresh bucket wouldn't.
+"""
+import logging
+import math
+import os
+import time
+import jwt
+from jwt.exceptions import InvalidTokenError
+from fastapi import HTTPException, Request, status
+from dotenv import load_dotenv
+from app import metrics, oauth2
+
+load_dotenv()
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_LOGIN = os.getenv("RATE_LIMIT_LOGIN", "10/60")
+RATE_LIMIT_VOTES = os.getenv("RATE_LIMIT_VOTES", "60/60")
+RATE_LIMIT_COMMENTS = os.getenv("RATE_LIMIT_COMMENTS", "20/60")
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL")
+# Behind a reverse proxy the client is the first X-Forwarded-For entry, not the socket peer
+RATE_LIMIT_TRUST_FORWARDED = os.getenv("RATE_LIMIT_TRUST_FORWARDED", "false").lower() == "true"
+RATE_LIMIT_SWEEP_SECONDS = 60
+
+rejected_total = metrics.Counter(
+    "rate_limit_rejected_total", "Requests answered 429 by a rate limiter", ("limiter",)
+)
+
+logger = logging.getLogger(__name__)
+
+
+def parse_limit(limit: str) -> tuple[float, float]:
+    """'30/60' -> (rate per second, burst)"""
+    requests, _, seconds = limit.partition("/")
+    return int(requests) / float(seconds or 1), float(requests)
+
+
+class MemoryBackend:
+    """Buckets of one worker: key -> (tokens, last update), as tuples to keep the dict small."""
+
+    def __init__(self):
+        self._buckets: dict[str, tuple[float, float]] = {}
+        self._next_sweep = time.monotonic() + RATE_LIMIT_SWEEP_SECONDS
+
+    async def take(self, key: str, rate: float, burst: float) -> float:
+        """Takes one token. Returns 0 if allowed, else the seconds until a token is available."""
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self._sweep(now, rate, burst)
+        entry = self._buckets.get(key)
+        tokens = burst if entry is None else min(burst, entry[0] + (now - entry[1]) * rate)
+        if tokens >= 1:
+            self._buckets[key] = (tokens - 1, now)
+            return 0.0
+        self._buckets[key] = (tokens, now)
+        return (1 - tokens) / rate
+
+    def _sweep(self, now: float, rate: float, burst: float):
+        # One backend per limiter, so rate/burst are the same for every key
+        self._buckets = {
+            key: entry for key, entry in self._buckets.items() if entry[0] + (now - entry[1]) * rate < burst
+        }
+        self._next_sweep = now + RATE_LIMIT_SWEEP_SECONDS
+
+
+# KEYS[1] bucket, ARGV rate, burst. Redis' clock, so workers don't need synchronized clocks.
+_REDIS_TAKE = """
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 't', 'u')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + (now - updated) * rate)
+local retry = 0
+if tokens >= 1 then tokens = tokens - 1 else retry = (1 - tokens) / rate end
+redis.call('HSET', KEYS[1], 't', tostring(tokens), 'u', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+return tostring(retry)
+"""
+
+class RedisBackend:
+    """Buckets shared by every worker. Fails open: if Redis is unreachable requests go through."""
+
+    def __init__(self, url: str, prefix: str):
+        import redis.asyncio as redis  # optional dependency, only needed with RATE_LIMIT_REDIS_URL
+        self._client = redis.from_url(url)
+        self._take = self._client.register_script(_REDIS_TAKE)
+        self._prefix = prefix
+
+    async def take(self, key: str, rate: float, burst: float) -> float:
+        try:
+            return float(await self._take(keys=[f"{self._prefix}:{key}"], args=[rate, burst]))
+        except Exception:
+            logger.exception("rate limit backend unavailable, allowing request")
+            return 0.0
+
+
+def client_ip(request: Request) -> str:
+    if RATE_LIMIT_TRUST_FORWARDED:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",", 1)[0].strip()
+    return request.client.host if request.client else "unknown"
+
+# access token -> (user id, exp): a client sends the same token for its whole lifetime
+_token_users: dict[str, tuple[str, float]] = {}
+
+def token_user(request: Request) -> str | None:
+    """User id of a valid access token, without a DB lookup (get_current_user still does the real check)."""
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    cached = _token_users.get(token)
+    if cached is not None and cached[1] > time.time():
+        return cached[0]
+    try:
+        payload = jwt.decode(token, oauth2.SECRET_KEY, algorithms=[oauth2.ALGORITHM])
+    except InvalidTokenError:
+        return None
+    if payload.get("typ") != "access" or payload.get("sub") is None:
+        return None
+    if len(_token_users) > 10000:
+        _token_users.clear()
+    _token_users[token] = (str(payload["sub"]), payload.get("exp", 0))
+    return _token_users[token][0]
+
+
+class RateLimiter:
+    """
+    Dependency enforcing one limit for a group of routes. by="user" keys by the token's user
+    id (falling back to the IP for anonymous requests), by="ip" always by client IP.
+    """
+
+    def __init__(self, name: str, limit: str, by: str = "user"):
+        self.name = name
+        self.rate, self.burst = parse_limit(limit)
+        self.by = by
+        self.backend = RedisBackend(RATE_LIMIT_REDIS_URL, f"ratelimit:{name}") if RATE_LIMIT_REDIS_URL else MemoryBackend()
+
+    def key(self, request: Request) -> str:
+        if self.by == "user":
+            user_id = token_user(request)
+            if user_id is not None:
+                return "u" + user_id
+        return "ip" + client_ip(request)
+
+    async def __call__(self, request: Request):
+        if not RATE_LIMIT_ENABLED:
+            return
+        retry_after = await self.backend.take(self.key(request), self.rate, self.burst)
+        if retry_after > 0:
+            rejected_total.inc(limiter=self.name)
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests",
+                headers={"Retry-After": str(math.ceil(retry_after))}
+            )
+
+
+# Route groups
+login = RateLimiter("login", RATE_LIMIT_LOGIN, by="ip")
+votes = RateLimiter("votes", RATE_LIMIT_VOTES)
+comments = RateLimiter("comments", RATE_LIMIT_COMMENTS)
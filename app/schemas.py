@@ -21,11 +21,21 @@ class User_out_min(BaseModel):
     id: int 
     username: str = Field(max_length=18)
 
+class User_profile(User_out_min):
+    created_at: datetime
+    post_count: int
+    comment_count: int
+    post_karma: int
+    comment_karma: int
+
 class Post_in(BaseModel):
     title: str 
     content: str
     published: Optional[bool] = True
       
+class Post_bulk_in(BaseModel):
+    posts: list[Post_in] = Field(min_length=1, max_length=1000)
+
 class Post_out(Post_in):
     id: int
     author_id: int
@@ -34,6 +44,18 @@ class Post_out(Post_in):
     comments_count: int
     created_at: datetime
     
+class Similar_query(BaseModel):
+    query: str = Field(min_length=1, max_length=500)
+    limit: int = Field(default=10, gt=0, le=100)
+
+class Similar_batch_in(BaseModel):
+    queries: list[Similar_query] = Field(min_length=1, max_length=20)
+
+class Typeahead_out(BaseModel):
+    type: str = Field(description="user or post")
+    id: int
+    text: str
+
 class VoteCreate(BaseModel):
     direction: int = Field(..., description="1 for Up, -1 for Down")
     is_super: bool = False
@@ -0,0 +1,55 @@
+import asyncio
+import os
+from dotenv import load_dotenv
+from app import metrics
+
+load_dotenv()
+
+# Routes that coalesce identical concurrent reads, e.g. "similar,comments"
+SINGLEFLIGHT_ROUTES = {
+    name.strip() for name in os.getenv("SINGLEFLIGHT_ROUTES", "similar,comments").split(",") if name.strip()
+}
+
+calls_total = metrics.Counter(
+    "singleflight_calls_total", "Read requests that entered a single-flight group", ("group",)
+)
+shared_total = metrics.Counter(
+    "singleflight_shared_total", "Read requests answered by another request's in-flight call", ("group",)
+)
+
+
+class SingleFlight:
+    """
+    Concurrent calls with the same key share one in-flight coroutine and all get its result
+    (or its exception). Nothing is kept once the call finishes, so no stale data is served.
+    """
+
+    def __init__(self, name: str, enabled: bool | None = None):
+        self.name = name
+        self.enabled = name in SINGLEFLIGHT_ROUTES if enabled is None else enabled
+        self._inflight: dict = {}
+
+    async def do(self, key, fn):
+        if not self.enabled:
+            return await fn()
+        calls_total.inc(group=self.name)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            shared_total.inc(group=self.name)
+        # shield so one waiter disconnecting doesn't cancel the call for the others
+        return await asyncio.shield(task)
+
+    def coalescing_ratio(self) -> float:
+        calls = calls_total.get(group=self.name)
+        return shared_total.get(group=self.name) / calls if calls else 0.0
+
+    def _done(self, key, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Every waiter may have gone away, mark the error as seen
+        if not task.cancelled():
+            task.exception()
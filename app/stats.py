@@ -0,0 +1,128 @@
+"""
+UserStats: post/comment counts and karma per user, for GET /users/{id}/profile.
+
+Every handler that changes one of them adds its delta in its own transaction (bump), so the
+profile is one primary-key lookup instead of COUNT/SUM scans. Rows are created by the first
+delta, so an existing database needs them backfilled from the real totals before the first
+deploy (scripts.migrate_schema). Counters kept this way drift (a crash between statements, a manual fix in SQL), so
+the scheduler recomputes them in batches, together with the Posts.comments_count counter
+that is maintained the same way.
+"""
+import os
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from dotenv import load_dotenv
+from app import model
+from app.db import async_session_factory
+from app.instrumentation import timed_task
+
+load_dotenv()
+
+STATS_RECONCILE_SECONDS = int(os.getenv("STATS_RECONCILE_SECONDS", "3600"))
+STATS_BATCH_SIZE = int(os.getenv("STATS_BATCH_SIZE", "1000"))
+# pg advisory lock key: one worker reconciles at a time, the others skip the run
+STATS_RECONCILE_LOCK = 4801
+
+STAT_COLUMNS = (model.UserStats.post_count, model.UserStats.comment_count,
+                model.UserStats.post_karma, model.UserStats.comment_karma)
+
+
+async def bump(session: AsyncSession, user_id: int, **deltas: int):
+    """bump(session, user_id, post_count=1, post_karma=-3). No commit."""
+    statement = insert(model.UserStats).values(user_id=user_id, **deltas)
+    statement = statement.on_conflict_do_update(
+        index_elements=["user_id"],
+        set_={name: getattr(model.UserStats, name) + statement.excluded[name] for name in deltas},
+    )
+    await session.execute(statement)
+
+async def remove_post_comments(session: AsyncSession, post_id: int):
+    """Before a post is deleted: its comments go with it (cascade), take them off their authors' stats. No commit."""
+    await session.execute(text("""
+        UPDATE userstats SET comment_count = userstats.comment_count - gone.comments,
+                             comment_karma = userstats.comment_karma - gone.karma
+        FROM (
+            SELECT user_id, count(*) FILTER (WHERE NOT is_deleted) AS comments, sum(votes) AS karma
+            FROM comments WHERE post_id = :post_id GROUP BY user_id
+        ) AS gone
+        WHERE userstats.user_id = gone.user_id
+    """), {"post_id": post_id})
+
+
+# A batch first locks the counter rows it recomputes (creating missing userstats rows so
+# there is something to lock): in-flight bumps commit before, later ones wait until after.
+# The recompute is the next statement, whose fresh snapshot (READ COMMITTED) includes every
+# bump that got in first, so no delta is overwritten by stale totals.
+_lock_users = (
+    text("INSERT INTO userstats (user_id) SELECT unnest(CAST(:ids AS integer[])) AS id ORDER BY id "
+         "ON CONFLICT DO NOTHING"),
+    text("SELECT user_id FROM userstats WHERE user_id = ANY(:ids) ORDER BY user_id FOR UPDATE"),
+)
+_lock_posts = (
+    text("SELECT id FROM posts WHERE id = ANY(:ids) ORDER BY id FOR UPDATE"),
+)
+
+# Only rows that actually differ are written, a pass over clean data only takes the locks
+_reconcile_users = text("""
+    INSERT INTO userstats (user_id, post_count, comment_count, post_karma, comment_karma)
+    SELECT u.id,
+           coalesce(p.posts, 0), coalesce(c.comments, 0), coalesce(p.karma, 0), coalesce(c.karma, 0)
+    FROM users AS u
+    LEFT JOIN LATERAL (
+        SELECT count(*) AS posts, sum(votes) AS karma FROM posts WHERE author_id = u.id
+    ) AS p ON true
+    LEFT JOIN LATERAL (
+        SELECT count(*) FILTER (WHERE NOT is_deleted) AS comments, sum(votes) AS karma FROM comments WHERE user_id = u.id
+    ) AS c ON true
+    WHERE u.id = ANY(:ids)
+    ON CONFLICT (user_id) DO UPDATE SET
+        post_count = excluded.post_count, comment_count = excluded.comment_count,
+        post_karma = excluded.post_karma, comment_karma = excluded.comment_karma
+    WHERE (userstats.post_count, userstats.comment_count, userstats.post_karma, userstats.comment_karma)
+          IS DISTINCT FROM (excluded.post_count, excluded.comment_count, excluded.post_karma, excluded.comment_karma)
+""")
+
+_reconcile_posts = text("""
+    UPDATE posts SET comments_count = counted.comments
+    FROM (
+        SELECT p.id, (SELECT count(*) FROM comments WHERE post_id = p.id AND NOT is_deleted) AS comments
+        FROM posts AS p WHERE p.id = ANY(:ids)
+    ) AS counted
+    WHERE posts.id = counted.id AND posts.comments_count != counted.comments
+""")
+
+
+async def _reconcile(table: str, locks: tuple, statement):
+    # Keyset batches, each its own short transaction
+    after = 0
+    while True:
+        async with async_session_factory() as session:
+            result = await session.execute(
+                text(f"SELECT id FROM {table} WHERE id > :after ORDER BY id LIMIT :batch"),
+                {"after": after, "batch": STATS_BATCH_SIZE}
+            )
+            ids = result.scalars().all()
+            if not ids:
+                return
+            for lock in locks:
+                await session.execute(lock, {"ids": ids})
+            await session.execute(statement, {"ids": ids})
+            await session.commit()
+        after = ids[-1]
+
+@timed_task
+async def reconcile_stats():
+    """
+    Scheduler job: recomputes UserStats and Posts.comments_count from the source rows.
+    Writes to a batch's users/posts wait for that batch's short transaction.
+    """
+    async with async_session_factory() as lock_session:
+        locked = await lock_session.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": STATS_RECONCILE_LOCK})
+        if not locked.scalar():
+            return
+        try:
+            await _reconcile("users", _lock_users, _reconcile_users)
+            await _reconcile("posts", _lock_posts, _reconcile_posts)
+        finally:
+            await lock_session.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": STATS_RECONCILE_LOCK})
@@ -0,0 +1,87 @@
+"""
+Trending feed: vote velocity instead of lifetime votes.
+
+Every vote and unvote adds its weight to a per-minute PostVoteBuckets row in the same
+transaction. Every TRENDING_REFRESH_SECONDS the scheduler sums the buckets of the last
+TRENDING_WINDOW_MINUTES, each weighted by 0.5^(age / half-life), and keeps the top
+TRENDING_SIZE posts in memory. /feed/trending only slices that snapshot.
+"""
+import os
+from datetime import timedelta
+from sqlalchemy import func, delete, literal, DateTime
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlmodel import select
+from dotenv import load_dotenv
+from app import model, projection
+from app.db import async_session_factory, read_session
+from app.instrumentation import timed_task
+from app.cache import make_etag
+
+load_dotenv()
+
+TRENDING_WINDOW_MINUTES = int(os.getenv("TRENDING_WINDOW_MINUTES", "60"))
+TRENDING_HALF_LIFE_MINUTES = float(os.getenv("TRENDING_HALF_LIFE_MINUTES", "15"))
+TRENDING_SIZE = int(os.getenv("TRENDING_SIZE", "100"))
+TRENDING_REFRESH_SECONDS = int(os.getenv("TRENDING_REFRESH_SECONDS", "5"))
+
+
+async def record_vote(session: AsyncSession, post_id: int, change: int, at=None):
+    """
+    Adds change to the post's bucket for the minute of `at` (default now). Unvotes pass the
+    original vote's created_at so a vote taken back inside the window cancels out. No commit.
+    """
+    bucket = func.date_trunc("minute", literal(at, DateTime(timezone=True)) if at is not None else func.now())
+    statement = insert(model.PostVoteBuckets).values(post_id=post_id, bucket_start=bucket, votes=change)
+    statement = statement.on_conflict_do_update(
+        index_elements=["post_id", "bucket_start"],
+        set_={"votes": model.PostVoteBuckets.votes + statement.excluded.votes},
+    )
+    await session.execute(statement)
+
+
+def trending_statement():
+    age = func.extract("epoch", func.now() - model.PostVoteBuckets.bucket_start)
+    score = func.sum(model.PostVoteBuckets.votes * func.power(0.5, age / (TRENDING_HALF_LIFE_MINUTES * 60))).label("score")
+    scores = (
+        select(model.PostVoteBuckets.post_id, score)
+        .where(model.PostVoteBuckets.bucket_start > func.now() - timedelta(minutes=TRENDING_WINDOW_MINUTES))
+        .group_by(model.PostVoteBuckets.post_id)
+        .order_by(score.desc())
+        .limit(TRENDING_SIZE)
+        .subquery()
+    )
+    return (
+        projection.select_posts()
+        .join(scores, scores.c.post_id == model.Posts.id)
+        .where(scores.c.score > 0, model.Posts.duplicate_of.is_(None))
+        .order_by(scores.c.score.desc())
+    )
+
+# The current top-N as PostRows
+_snapshot: list = []
+
+@timed_task
+async def refresh_trending():
+    """Scheduler job, runs in every worker: each keeps its own copy of the snapshot."""
+    global _snapshot
+    async with read_session() as session:
+        result = await session.execute(trending_statement())
+        _snapshot = [projection.to_post(row) for row in result]
+
+def trending_page(limit: int, offset: int) -> tuple[bytes, str]:
+    """(serialized List[Post_out], etag) of a slice of the snapshot"""
+    # Content etag: the same ranking answers 304 across refreshes and across workers
+    body = projection.dumps(_snapshot[offset:offset + limit])
+    return body, make_etag(body)
+
+@timed_task
+async def cleanup_vote_buckets():
+    """Buckets past the window no longer count"""
+    async with async_session_factory() as session:
+        async with session.begin():
+            await session.execute(
+                delete(model.PostVoteBuckets).where(
+                    model.PostVoteBuckets.bucket_start < func.now() - timedelta(minutes=TRENDING_WINDOW_MINUTES)
+                )
+            )
@@ -1,11 +1,14 @@
 from pwdlib import PasswordHash
+from fastapi import Request
 from sqlmodel import delete, select
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import text
-from numpy import array
-from app.db import async_session_factory
+from numpy import arange, array
+from asyncio import get_running_loop
+from app.db import async_session_factory, current_route, read_session
 from datetime import datetime, timezone
 from app import model
+from app.instrumentation import timed_call, timed_task
 
 password_hasher = PasswordHash.recommended()
 
@@ -18,9 +21,46 @@ def verify_password(plain_password, hashed_password):
     return password_hasher.verify(plain_password, hashed_password)
 
 async def get_db() -> AsyncSession:
+    """
+    One session per request: FastAPI caches this dependency, so oauth2.get_current_user and the
+    handler share it. It only checks a connection out on its first execute.
+    """
     async with async_session_factory() as session:
         yield session
 
+async def release_connection(session: AsyncSession):
+    """
+    Hands the session's pooled connection back before a long non-DB await (inference, hashing);
+    the next execute checks one out again. Loaded objects stay usable (expire_on_commit=False).
+    Nothing happens while the session holds writes, those still need their transaction.
+    """
+    if session.in_transaction() and not (session.info.get("wrote") or session.new or session.dirty or session.deleted):
+        await session.commit()
+
+async def run_in_executor(session: AsyncSession | None, func, *args):
+    """
+    Runs a blocking call (encode_text, password hashing) in the executor without holding a DB connection.
+    Queue wait and run time are recorded per function name.
+    """
+    if session is not None:
+        await release_connection(session)
+    loop = get_running_loop()
+    return await loop.run_in_executor(None, timed_call(func, *args))
+
+async def get_read_db(request: Request) -> AsyncSession:
+    """
+    get_db for read-only routes: a replica session, or the primary for a caller who wrote recently.
+    The caller is known once oauth2.get_current_user has run, so declare it before this dependency.
+    """
+    user_id = getattr(request.state, "user_id", None)
+    async with read_session(("user", user_id) if user_id is not None else None) as session:
+        yield session
+
+async def track_route(request: Request):
+    """Labels DB accounting with the route template, see app.db.DB_TRACK_FETCH_BYTES"""
+    current_route.set(request.scope["route"].path)
+
+@timed_task
 async def cleanup_revoked_tokens():
     """Delete revoked refresh tokens from database"""
     async with async_session_factory() as session:  # fix: was `with` (sync), must be `async with`
@@ -29,6 +69,7 @@ async def cleanup_revoked_tokens():
             .where(model.RefreshTokens.is_revoked == True)
             await session.execute(statement)
 
+@timed_task
 async def cleanup_expired_tokens():
     """Delete expired refresh tokens from database"""
     async with async_session_factory() as session:  # fix: was `with` (sync), must be `async with`
@@ -38,6 +79,29 @@ async def cleanup_expired_tokens():
             )
             await session.execute(statement)
 
+def blend_embedding(current_embedding, embedding):
+    """EMA of the user embedding towards a post embedding, computed in Python: pgvector has no scalar*vector operator."""
+    new_emb = array(embedding)
+    if current_embedding is not None:
+        new_emb = (1 - LEARNING_RATE) * array(current_embedding) + LEARNING_RATE * new_emb
+    return new_emb
+
+def blend_embeddings(current_embedding, embeddings: list):
+    """
+    Same result as blend_embedding applied once per embedding, in order, without the loop:
+    u_n = (1-a)^n * u_0 + sum_i a * (1-a)^(n-i) * e_i  (the first embedding seeds a missing u_0).
+    """
+    embeddings = array(embeddings)
+    if current_embedding is None:
+        current_embedding, embeddings = embeddings[0], embeddings[1:]
+    n = len(embeddings)
+    weights = LEARNING_RATE * (1 - LEARNING_RATE) ** arange(n - 1, -1, -1)
+    return (1 - LEARNING_RATE) ** n * array(current_embedding) + weights @ embeddings
+
+def vector_literal(values) -> str:
+    """pgvector text format, for CAST(:emb AS vector(384))"""
+    return "[" + ",".join(str(x) for x in values.tolist()) + "]"
+
 async def update_user_embedding(user_id: int, session: AsyncSession, embedding: list):
     # Fetch the user's current embedding
     result = await session.execute(
@@ -45,19 +109,14 @@ async def update_user_embedding(user_id: int, session: AsyncSession, embedding:
     )
     current_embedding = result.scalar_one_or_none()
 
-    # Compute EMA in Python — pgvector has no scalar*vector operator
-    new_emb = array(embedding)
-    if current_embedding is not None:
-        new_emb = (1 - LEARNING_RATE) * array(current_embedding) + LEARNING_RATE * new_emb
-
-    # Serialize to pgvector string format and write back
-    emb_str = "[" + ",".join(str(x) for x in new_emb.tolist()) + "]"
+    emb_str = vector_literal(blend_embedding(current_embedding, embedding))
     await session.execute(
         text("UPDATE users SET embedding = CAST(:emb AS vector(384)) WHERE id = :user_id"),
         {"emb": emb_str, "user_id": user_id}
     )
     await session.commit()
 
+@timed_task
 async def run_background_update(user_id: int, embedding: list):
     """
     Runs after the user has received their response.
@@ -65,3 +124,29 @@ async def run_background_update(user_id: int, embedding: list):
     """
     async with async_session_factory() as session:
         await update_user_embedding(user_id, session, embedding)
+
+@timed_task
+async def run_background_bulk_update(user_id: int, embeddings: list):
+    """One EMA update for a batch of new posts instead of one per post."""
+    if not embeddings:
+        return
+    async with async_session_factory() as session:
+        result = await session.execute(select(model.Users.embedding).where(model.Users.id == user_id))
+        emb_str = vector_literal(blend_embeddings(result.scalar_one_or_none(), embeddings))
+        await session.execute(
+            text("UPDATE users SET embedding = CAST(:emb AS vector(384)) WHERE id = :user_id"),
+            {"emb": emb_str, "user_id": user_id}
+        )
+        await session.commit()
+
+@timed_task
+async def run_background_vote_update(user_id: int, post_id: int):
+    """
+    Same as run_background_update, for a vote: the post embedding is deferred,
+    so it is only read here and never by the vote request itself.
+    """
+    async with async_session_factory() as session:
+        result = await session.execute(select(model.Posts.embedding).where(model.Posts.id == post_id))
+        embedding = result.scalar_one_or_none()
+        if embedding is not None:
+            await update_user_embedding(user_id, session, embedding)
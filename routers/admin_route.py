@@ -0,0 +1,36 @@
+from fastapi import APIRouter, HTTPException, Header, Depends, Query, status
+from fastapi.responses import PlainTextResponse
+from app import metrics, oauth2, profiler
+from dotenv import load_dotenv
+import secrets
+import time
+import os
+
+load_dotenv()
+
+# When set, /metrics wants "Authorization: Bearer <METRICS_TOKEN>" (scrapers can send it)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+router = APIRouter(tags=["Admin"])
+
+
+@router.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def get_metrics(authorization: str | None = Header(default=None)):
+    if METRICS_TOKEN and not secrets.compare_digest(authorization or "", f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authorized")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@router.get("/admin/profile", response_class=PlainTextResponse, dependencies=[Depends(oauth2.get_current_admin)])
+async def get_profile(route: str | None = Query(default=None, description="Route template, e.g. /feed/hot, or executor:encode_text"),
+                      since: float | None = Query(default=None, description="Unix time, defaults to 15 minutes ago"),
+                      until: float | None = Query(default=None, description="Unix time, defaults to now")):
+    """Collapsed stacks (flamegraph.pl / speedscope input) sampled from live requests."""
+    until = time.time() if until is None else until
+    since = until - 900 if since is None else since
+    return PlainTextResponse(profiler.collapsed_stacks(route, since, until))
+
+@router.post("/admin/profile/token", dependencies=[Depends(oauth2.get_current_admin)])
+async def create_profile_token(minutes: int = Query(default=10, gt=0, le=120)):
+    """Signed value for the X-Profile-Token header: requests carrying it are always profiled."""
+    return {"token": profiler.sign(int(time.time()) + minutes * 60)}
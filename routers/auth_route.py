@@ -1,19 +1,24 @@
-from fastapi import APIRouter, status, HTTPException, Depends
+from fastapi import APIRouter, status, HTTPException, Depends, Query
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlmodel import select 
 from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime, timedelta, timezone
-from app import schemas, model, utils, oauth2
+from app import schemas, model, utils, oauth2, projection, ratelimit
+from app.db import read_session
 from typing import Annotated
+import zlib
 
 ACCESS_TOKEN_EXPIRE_MIN = 30
 REFRESH_TOKEN_EXPIRE_DAY = 7
+# Rows fetched per round trip by the export cursors
+EXPORT_BATCH_SIZE = 1000
 
 
 router = APIRouter(prefix="/auth", tags=["Authentification"])
 
 
-@router.post("/register", response_model=schemas.User_out_min)
+@router.post("/register", response_model=schemas.User_out_min, dependencies=[Depends(ratelimit.login)])
 async def new_user(user: schemas.User_new, session: Annotated[AsyncSession, Depends(utils.get_db)]):
     # Check if user already exists
     existing_user = await session.execute(select(model.Users).where(model.Users.username == user.username))
@@ -24,14 +29,14 @@ async def new_user(user: schemas.User_new, session: Annotated[AsyncSession, Depe
             detail="User with this email already exists"
         )
     
-    password_hash = utils.get_password_hash(user.password)
+    password_hash = await utils.run_in_executor(session, utils.get_password_hash, user.password)
     db_user = model.Users(username=user.username, email=user.email, password=password_hash) 
     session.add(db_user)
     await session.commit()
     await session.refresh(db_user)
     return db_user 
 
-@router.post("/token")
+@router.post("/token", dependencies=[Depends(ratelimit.login)])
 async def login_for_access_token(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
     session: Annotated[AsyncSession, Depends(utils.get_db)]
@@ -53,7 +58,8 @@ async def login_for_access_token(
         data={"sub": str(user.id)}, expires_delta=refresh_token_expires
     )
     
-    refresh_token_db = model.RefreshTokens(user_id=user.id, token_hash=utils.get_password_hash(refresh_token),
+    token_hash = await utils.run_in_executor(session, utils.get_password_hash, refresh_token)
+    refresh_token_db = model.RefreshTokens(user_id=user.id, token_hash=token_hash,
                                            jti=jti, expires_at=datetime.now(timezone.utc)+refresh_token_expires, is_revoked=False)
     session.add(refresh_token_db)
     await session.commit()
@@ -75,7 +81,8 @@ async def refresh(
         data={"sub": str(user_id)}, expires_delta=refresh_token_expires
     )
     
-    refresh_token_db = model.RefreshTokens(user_id=user_id, token_hash=utils.get_password_hash(refresh_token),
+    token_hash = await utils.run_in_executor(session, utils.get_password_hash, refresh_token)
+    refresh_token_db = model.RefreshTokens(user_id=user_id, token_hash=token_hash,
                                            jti=jti, expires_at=datetime.now(timezone.utc)+refresh_token_expires, is_revoked=False)
     session.add(refresh_token_db)
     await session.commit()
@@ -117,6 +124,69 @@ async def logout(
         await session.commit()
 
 
+def export_queries(user_id: int, include_embeddings: bool) -> list:
+    """(type, statement) per NDJSON record kind, plain columns so nothing goes through the ORM identity map"""
+    user_columns = [model.Users.id, model.Users.username, model.Users.email, model.Users.super_vote_balance, model.Users.created_at]
+    post_columns = [model.Posts.id, model.Posts.title, model.Posts.content, model.Posts.published, model.Posts.votes,
+                    model.Posts.comments_count, model.Posts.created_at, model.Posts.modified_at]
+    if include_embeddings:
+        user_columns.append(model.Users.embedding)
+        post_columns.append(model.Posts.embedding)
+    return [
+        ("user", select(*user_columns).where(model.Users.id == user_id)),
+        ("post", select(*post_columns).where(model.Posts.author_id == user_id).order_by(model.Posts.id)),
+        ("comment", select(model.Comments.id, model.Comments.post_id, model.Comments.parent_id, model.Comments.content,
+                           model.Comments.votes, model.Comments.is_deleted, model.Comments.created_at, model.Comments.modified_at)
+                    .where(model.Comments.user_id == user_id).order_by(model.Comments.id)),
+        # Index-only scans of the (user_id, target) INCLUDE indexes
+        ("vote", select(model.PostVotes.post_id, model.PostVotes.direction, model.PostVotes.is_super, model.PostVotes.created_at)
+                 .where(model.PostVotes.user_id == user_id).order_by(model.PostVotes.post_id)),
+        ("vote", select(model.CommentVotes.comment_id, model.CommentVotes.direction, model.CommentVotes.is_super,
+                        model.CommentVotes.created_at)
+                 .where(model.CommentVotes.user_id == user_id).order_by(model.CommentVotes.comment_id)),
+    ]
 
+def export_record(kind: str, row) -> bytes:
+    record = {"type": kind, **row._mapping}
+    if record.get("embedding") is not None:
+        record["embedding"] = record["embedding"].tolist()
+    return projection.dumps(record) + b"\n"
 
+async def export_lines(user_id: int, include_embeddings: bool):
+    # Server-side cursors: one batch of EXPORT_BATCH_SIZE rows in memory at a time, whatever the account size
+    async with read_session(("user", user_id)) as session:
+        for kind, statement in export_queries(user_id, include_embeddings):
+            result = await session.stream(statement.execution_options(yield_per=EXPORT_BATCH_SIZE))
+            async for rows in result.partitions():
+                yield b"".join(export_record(kind, row) for row in rows)
+
+async def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+@router.get("/me/export")
+async def export_me(
+    current_user: Annotated[schemas.User_out, Depends(oauth2.get_current_user)],
+    session: Annotated[AsyncSession, Depends(utils.get_db)],
+    compress: bool = Query(default=False, description="gzip the export on the fly"),
+    include_embeddings: bool = Query(default=False, description="add the 384-float embedding vectors"),
+):
+    """
+    The caller's account, posts, comments and votes as NDJSON, one {"type": ...} record per line,
+    streamed straight from the database.
+    """
+    user_id = current_user.id
+    # The export uses its own session, don't hold the auth lookup's connection as well
+    await utils.release_connection(session)
+    body = export_lines(user_id, include_embeddings)
+    filename = f"export-{user_id}.ndjson"
+    if compress:
+        return StreamingResponse(gzip_chunks(body), media_type="application/gzip",
+                                 headers={"Content-Disposition": f'attachment; filename="{filename}.gz"'})
+    return StreamingResponse(body, media_type="application/x-ndjson",
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
 
@@ -1,14 +1,28 @@
-from sqlalchemy.orm import joinedload
-from fastapi import APIRouter, status, HTTPException, Depends, Query
+from fastapi import APIRouter, status, HTTPException, Depends, Query, Response
+from fastapi.responses import StreamingResponse
 from sqlmodel import update, select
+from sqlalchemy import lambda_stmt
 from sqlalchemy.ext.asyncio import AsyncSession
-from app import schemas, model, oauth2, utils
+from app import schemas, model, oauth2, utils, projection, live, ratelimit, stats
+from app.db import read_session, pin_primary
+from app.singleflight import SingleFlight
+from app.cache import invalidate_post, publish_invalidation
 from typing import Annotated, List
 
 router = APIRouter(prefix="/comments", tags=["Comment"])
 
 SUPER_VOTE_MULTIPLIER = 10
 
+# Viewers of a busy thread polling the same page share one query
+comments_flight = SingleFlight("comments")
+
+def comment_vote_lookup(user_id: int, comment_id: int):
+    # Same cached lambda statement as vote_route.vote_lookup
+    return lambda_stmt(lambda: select(model.CommentVotes).where(
+        model.CommentVotes.comment_id == comment_id,
+        model.CommentVotes.user_id == user_id
+    ))
+
 @router.put("/edit", status_code=status.HTTP_200_OK, response_model=schemas.Comment_out)
 async def edit_comment( comment_in: schemas.Comment_edit,
                         current_user: Annotated[schemas.User_out, Depends(oauth2.get_current_user)],
@@ -34,7 +48,10 @@ async def edit_comment( comment_in: schemas.Comment_edit,
             .where(model.Comments.id == comment_in.id)
             .values(content=comment_in.content)
         )
+        await live.publish_comment(session, comment_in.id, "edited")
         await session.commit()
+        # Keeps the thread's next comment page on the primary, see get_comments
+        pin_primary(("post", comment_target.post_id))
         await session.refresh(comment_target)
         return comment_target
 
@@ -43,10 +60,11 @@ async def delete_comment(comment_id: int,
                          current_user: Annotated[schemas.User_out, Depends(oauth2.get_current_user)],
                          session: Annotated[AsyncSession, Depends(utils.get_db)]):
 
-        # Check if the comment exists
-        comment_target = await session.get(model.Comments, comment_id)
+        # Check if the comment exists. Locked: of two concurrent deletes the second waits,
+        # then sees is_deleted, instead of counting the comment out a second time
+        comment_target = await session.get(model.Comments, comment_id, with_for_update=True)
 
-        if not comment_target :
+        if not comment_target or comment_target.is_deleted:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND, 
                 detail=f"Comment with id: {comment_id} not found"
@@ -67,11 +85,15 @@ async def delete_comment(comment_id: int,
             .where(model.Posts.id == comment_target.post_id)
             .values(comments_count=model.Posts.comments_count - 1)
         )
+        await stats.bump(session, current_user.id, comment_count=-1)
         
         # await session.delete(comment_target)
+        await live.publish_comment(session, comment_id, "deleted")
+        await publish_invalidation(session, comment_target.post_id)
         await session.commit()
+        invalidate_post(comment_target.post_id)
 
-@router.post("/vote/{comment_id}", status_code=status.HTTP_201_CREATED)
+@router.post("/vote/{comment_id}", status_code=status.HTTP_201_CREATED, dependencies=[Depends(ratelimit.votes)])
 async def vote_comment(comment_id: int, vote_in: schemas.VoteCreate,
                     current_user: Annotated[schemas.User_out, Depends(oauth2.get_current_user)],
                     session: Annotated[AsyncSession, Depends(utils.get_db)]):
@@ -87,10 +109,7 @@ async def vote_comment(comment_id: int, vote_in: schemas.VoteCreate,
 
     
     # Check if user has already voted for this post
-    statement = select(model.Votes).where(
-    model.Votes.user_id == current_user.id,
-    model.Votes.comment_id == comment_id
-    )
+    statement = comment_vote_lookup(current_user.id, comment_id)
     result = await session.execute(statement)
     vote_target = result.scalar_one_or_none()
     if vote_target:
@@ -127,18 +146,21 @@ async def vote_comment(comment_id: int, vote_in: schemas.VoteCreate,
             .where(model.Comments.id == comment_id)
             .values(votes=model.Comments.votes + change)
         )
+    await stats.bump(session, comment_target.user_id, comment_karma=change)
 
     # Create new vote
-    new_vote = model.Votes(
+    new_vote = model.CommentVotes(
         user_id=current_user.id, 
         comment_id=comment_id, 
         direction=vote_in.direction, 
         is_super=vote_in.is_super
     )
     session.add(new_vote)
+    await live.publish_comment(session, comment_id, "voted")
     await session.commit()
+    pin_primary(("post", comment_target.post_id))
 
-@router.delete("/vote/{comment_id}", status_code=status.HTTP_204_NO_CONTENT)
+@router.delete("/vote/{comment_id}", status_code=status.HTTP_204_NO_CONTENT, dependencies=[Depends(ratelimit.votes)])
 async def unvote_comment(comment_id: int,
                     current_user: Annotated[schemas.User_out, Depends(oauth2.get_current_user)],
                     session: Annotated[AsyncSession, Depends(utils.get_db)]):
@@ -150,10 +172,7 @@ async def unvote_comment(comment_id: int,
             detail=f"Comment with id: {comment_id} not found"
         )
     
-    statement = select(model.Votes).where(
-    model.Votes.user_id == current_user.id,
-    model.Votes.comment_id == comment_id
-    )
+    statement = comment_vote_lookup(current_user.id, comment_id)
     result = await session.execute(statement)
     vote_target = result.scalar_one_or_none()
     if not vote_target:
@@ -172,6 +191,8 @@ async def unvote_comment(comment_id: int,
         .where(model.Comments.id == comment_id)
         .values(votes=model.Comments.votes - change)
     )
+    await stats.bump(session, comment_target.user_id, comment_karma=-change)
+    await live.publish_comment(session, comment_id, "voted")
     
     # Refund super vote if applicable
     if vote_target.is_super:
@@ -184,17 +205,36 @@ async def unvote_comment(comment_id: int,
     
     await session.delete(vote_target)
     await session.commit()
+    pin_primary(("post", comment_target.post_id))
 
-@router.get("/{post_id}", status_code=status.HTTP_200_OK, response_model=List[schemas.Comment_out])
-async def get_comments(post_id:int, session:Annotated[AsyncSession, Depends(utils.get_db)],
+@router.get("/{post_id}/stream")
+async def stream_comments(post_id: int,
     current_user: Annotated[schemas.User_out, Depends(oauth2.get_current_user)],
+    session: Annotated[AsyncSession, Depends(utils.get_db)]):
+    """
+    Server-Sent Events: one "comment" event ({"event": created|edited|deleted|voted, "comment": Comment_out})
+    per change on the post's comments. A "reset" event means events were lost, reload the page and reconnect.
+    """
+    # The stream can stay open for hours, it must not keep the auth lookup's pooled connection
+    await utils.release_connection(session)
+    return StreamingResponse(live.comment_hub.stream(post_id), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@router.get("/{post_id}", status_code=status.HTTP_200_OK, response_model=List[schemas.Comment_out])
+async def get_comments(post_id:int,
+    current_user: Annotated[schemas.User_out, Depends(oauth2.get_current_reader)],
     limit: int = Query(default=10, gt=0, le=100, description="Maximum number of items to return"),
     offset: int = Query(default=0, ge=0, description="Number of items to skip")):
 
-    comments = await session.execute(select(model.Comments).where(model.Comments.post_id == post_id).options(joinedload(model.Comments.author)).offset(offset).limit(limit))
-    return comments.scalars().all()
+    async def load_comments():
+        async with read_session(("post", post_id)) as session:
+            statement = projection.select_comments().where(model.Comments.post_id == post_id).offset(offset).limit(limit)
+            return await projection.fetch_comments(session, statement)
+
+    body = await comments_flight.do((post_id, limit, offset), load_comments)
+    return Response(content=body, media_type="application/json")
 
-@router.post("/{post_id}/create", status_code=status.HTTP_201_CREATED, response_model=schemas.Comment_out)
+@router.post("/{post_id}/create", status_code=status.HTTP_201_CREATED, response_model=schemas.Comment_out, dependencies=[Depends(ratelimit.comments)])
 async def create_comment(post_id: int, comment_in: schemas.Comment_in,
                         current_user: Annotated[schemas.User_out, Depends(oauth2.get_current_user)],
                         session: Annotated[AsyncSession, Depends(utils.get_db)]):
@@ -225,6 +265,7 @@ async def create_comment(post_id: int, comment_in: schemas.Comment_in,
         .where(model.Posts.id == post_id)
         .values(comments_count=model.Posts.comments_count + 1)
     )
+    await stats.bump(session, current_user.id, comment_count=1)
 
 
     # Create new comment
@@ -235,7 +276,12 @@ async def create_comment(post_id: int, comment_in: schemas.Comment_in,
         parent_id=comment_in.parent_id
     )
     session.add(new_comment)
+    # The id comes from the INSERT, publish_comment needs it
+    await session.flush()
+    await live.publish_comment(session, new_comment.id, "created")
+    await publish_invalidation(session, post_id)
     await session.commit()
+    invalidate_post(post_id)
     await session.refresh(new_comment, ['author'])#, 'replies'])
     return new_comment
 
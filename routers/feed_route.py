@@ -1,84 +1,170 @@
-from fastapi import APIRouter, status, Depends, Query
-from sqlmodel import  select
-from sqlalchemy import func
-from sqlalchemy.orm import joinedload
+from fastapi import APIRouter, status, Depends, Query, Request, Response
+from sqlmodel import select
+from sqlalchemy import func, lambda_stmt, cast, bindparam, true, text, String, Integer
+from sqlalchemy.dialects.postgresql import ARRAY
+from pgvector.sqlalchemy import Vector
 from sqlalchemy.ext.asyncio import AsyncSession
-from app import schemas, model, oauth2, utils
+from app import schemas, model, oauth2, utils, projection, trending
 from typing import Annotated, List
-import asyncio
-from app.encoder import encode_text
+from app.encoder import encode_text, encode_texts
+from app.db import read_session
+from app.cache import ResponseCache, json_response
+from app.singleflight import SingleFlight
+from dotenv import load_dotenv
+import os
 
-async def semantic_search(query_vector: list[float], session: AsyncSession, limit: int = 10, offset: int = 0):
+load_dotenv()
+
+# The hot ranking is the same for every viewer, so one worker-wide copy is enough
+HOT_FEED_TTL = 5
+HOT_FEED_STALE_TTL = 30
+hot_feed_cache = ResponseCache(ttl=HOT_FEED_TTL, stale_ttl=HOT_FEED_STALE_TTL)
+
+# Identical concurrent searches share one encode and one ANN query
+similar_flight = SingleFlight("similar")
+
+# HNSW hands back ef_search candidates and duplicate_of IS NULL is applied to those only: where
+# duplicates cluster (spam) a page comes back short or empty. pgvector >= 0.8 iterative scans
+# keep walking the graph until LIMIT rows pass the filter. Off by default: older pgvector
+# rejects the setting and every similar/personalized query would fail, opt in once on 0.8.
+HNSW_ITERATIVE_SCAN = os.getenv("HNSW_ITERATIVE_SCAN", "off")
+if HNSW_ITERATIVE_SCAN not in ("off", "strict_order", "relaxed_order"):
+    raise ValueError(f"HNSW_ITERATIVE_SCAN must be off, strict_order or relaxed_order, not {HNSW_ITERATIVE_SCAN!r}")
+
+async def filtered_vector_scan(session: AsyncSession):
+    """For the current transaction: filtered HNSW scans return full pages."""
+    if HNSW_ITERATIVE_SCAN != "off":
+        await session.execute(text(f"SET LOCAL hnsw.iterative_scan = {HNSW_ITERATIVE_SCAN}"))
+
+async def semantic_search(query_vector: list[float], session: AsyncSession, limit: int = 10, offset: int = 0) -> bytes:
     """
     Finds the most relevant posts using Cosine Distance.
     The HNSW index will automatically speed this up.
+    Returns the serialized List[Post_out].
     """
     statement = (
-        select(model.Posts)
+        projection.select_posts()
+        .where(model.Posts.duplicate_of.is_(None))
         # Cosine distance: lower distance = higher similarity
-        .options(joinedload(model.Posts.author))
         .order_by(model.Posts.embedding.cosine_distance(query_vector))
         .limit(limit)
         .offset(offset)
     )
-    
-    result = await session.execute(statement)
-    # .scalars() returns the Post objects directly
-    return result.scalars().all()
-
-async def get_hot_posts_query(session: AsyncSession, limit: int, offset: int):
-    # Move the score math here so both routes can use it
-    score_expression = (
-        func.log(func.greatest(func.abs(model.Posts.votes), 1)) +
-        (func.extract('epoch', model.Posts.created_at) - 1334845200) / 45000
-    ).label("hot_score")
+    await filtered_vector_scan(session)
+    return await projection.fetch_posts(session, statement)
 
-    statement = (
-        select(model.Posts)
-        .options(joinedload(model.Posts.author))
-        .order_by(score_expression.desc())
+# Every lookup of /similar/batch in one statement: unnest the query vectors with their limits,
+# then one LATERAL nearest-neighbour scan (HNSW) per vector. Authors are joined once, outside.
+_batch_queries = func.unnest(
+    cast(bindparam("vectors", type_=String), ARRAY(Vector(384))),
+    bindparam("limits", type_=ARRAY(Integer)),
+).table_valued("vector", "max_results", with_ordinality="position").render_derived()
+_batch_distance = model.Posts.embedding.cosine_distance(_batch_queries.c.vector).label("distance")
+_batch_nearest = (
+    select(model.Posts.id, _batch_distance)
+    .where(model.Posts.duplicate_of.is_(None))
+    .order_by(_batch_distance)
+    .limit(_batch_queries.c.max_results)
+    .correlate(_batch_queries)
+    .lateral("nearest")
+)
+SIMILAR_BATCH_STATEMENT = (
+    select(*projection.POST_COLUMNS, _batch_queries.c.position)
+    .select_from(_batch_queries)
+    .join(_batch_nearest, true())
+    .join(model.Posts, model.Posts.id == _batch_nearest.c.id)
+    .join(model.Users, model.Users.id == model.Posts.author_id)
+    .order_by(_batch_queries.c.position, _batch_nearest.c.distance)
+)
+
+def vector_array_literal(vectors: list) -> str:
+    """Postgres array literal of pgvector values, cast to vector[] in SQL"""
+    return "{" + ",".join('"[' + ",".join(map(str, vector)) + ']"' for vector in vectors) + "}"
+
+async def semantic_search_batch(query_vectors: list, limits: list[int], session: AsyncSession) -> bytes:
+    """Returns the serialized List[List[Post_out]], one list per query vector, in order."""
+    await filtered_vector_scan(session)
+    result = await session.execute(
+        SIMILAR_BATCH_STATEMENT, {"vectors": vector_array_literal(query_vectors), "limits": limits}
+    )
+    pages = [[] for _ in query_vectors]
+    for row in result:
+        pages[row[-1] - 1].append(projection.to_post(row))
+    return projection.dumps(pages)
+
+# Move the score math here so both routes can use it
+HOT_SCORE = (
+    func.log(func.greatest(func.abs(model.Posts.votes), 1)) +
+    (func.extract('epoch', model.Posts.created_at) - 1334845200) / 45000
+).label("hot_score")
+
+async def get_hot_posts_query(session: AsyncSession, limit: int, offset: int) -> bytes:
+    # Lambda statement: built and compiled once, limit/offset are bound per call
+    statement = lambda_stmt(lambda: (
+        projection.select_posts()
+        .where(model.Posts.duplicate_of.is_(None))
+        .order_by(HOT_SCORE.desc())
         .limit(limit)
         .offset(offset)
-    )
-    result = await session.execute(statement)
-    return result.scalars().all()
+    ))
+    return await projection.fetch_posts(session, statement)
 
 router = APIRouter(prefix='/feed', tags=['Feed'])
 
-@router.get('/hot', status_code=status.HTTP_200_OK, response_model=List[schemas.Post_out], dependencies=[Depends(oauth2.get_current_user)])
-async def get_hot_feed(session: Annotated[AsyncSession, Depends(utils.get_db)], 
+@router.get('/hot', status_code=status.HTTP_200_OK, response_model=List[schemas.Post_out], dependencies=[Depends(oauth2.get_current_user_id)])
+async def get_hot_feed(request: Request,
                         limit: int = Query(default=10, le=100),
                         offset: int = Query(default=0, le=1000)):
-        posts = await get_hot_posts_query(session, limit, offset)
-        return posts
+        # The loader opens its own session: it may outlive this request when it runs as a background refresh
+        async def load_hot_page():
+            async with read_session() as session:
+                return await get_hot_posts_query(session, limit, offset)
+
+        return await hot_feed_cache.respond(request, ("hot", limit, offset), load_hot_page)
 
-@router.get('/similar/{query}', status_code=status.HTTP_200_OK, response_model=List[schemas.Post_out], dependencies=[Depends(oauth2.get_current_user)])
-async def get_similar_feed(session: Annotated[AsyncSession, Depends(utils.get_db)], 
-                        query: str,
+@router.get('/trending', status_code=status.HTTP_200_OK, response_model=List[schemas.Post_out], dependencies=[Depends(oauth2.get_current_user_id)])
+async def get_trending_feed(request: Request,
+                        limit: int = Query(default=10, gt=0, le=100),
+                        offset: int = Query(default=0, ge=0, le=1000)):
+    # Precomputed by the scheduler (app.trending), no query here
+    body, etag = trending.trending_page(limit, offset)
+    return json_response(request, body, etag, max_age=trending.TRENDING_REFRESH_SECONDS)
+
+@router.get('/similar/{query}', status_code=status.HTTP_200_OK, response_model=List[schemas.Post_out], dependencies=[Depends(oauth2.get_current_reader)])
+async def get_similar_feed(query: str,
                         limit: int = Query(default=10, le=100),
                         offset: int = Query(default=0, le=1000)):
-            
-    loop = asyncio.get_running_loop()
-    query_vector = await loop.run_in_executor(
-        None, 
-        encode_text, 
-        query
-    )
-    
-    # 2. Query the DB using our semantic_search function
-    posts = await semantic_search(query_vector, session, limit, offset)
-    
-    return posts
+
+    async def search_similar():
+        query_vector = await utils.run_in_executor(None, encode_text, query)
+
+        # 2. Query the DB using our semantic_search function
+        async with read_session() as session:
+            return await semantic_search(query_vector, session, limit, offset)
+
+    body = await similar_flight.do((query, limit, offset), search_similar)
+    return Response(content=body, media_type="application/json")
+
+@router.post('/similar/batch', status_code=status.HTTP_200_OK, response_model=List[List[schemas.Post_out]], dependencies=[Depends(oauth2.get_current_reader)])
+async def get_similar_batch(batch: schemas.Similar_batch_in):
+    """Several /similar lookups at once: one encode batch and one SQL round trip for all of them."""
+    query_vectors = await utils.run_in_executor(None, encode_texts, [item.query for item in batch.queries])
+    async with read_session() as session:
+        body = await semantic_search_batch(query_vectors, [item.limit for item in batch.queries], session)
+    return Response(content=body, media_type="application/json")
 
 @router.get('/personalized', response_model=List[schemas.Post_out])
 async def get_personalized_feed(
-    current_user: Annotated[model.Users, Depends(oauth2.get_current_user)], 
-    session: Annotated[AsyncSession, Depends(utils.get_db)],
+    current_user: Annotated[model.Users, Depends(oauth2.get_current_reader)], 
+    session: Annotated[AsyncSession, Depends(utils.get_read_db)],
     limit: int = Query(10),
     offset: int = Query(0)
 ):
-    if current_user.embedding is None:
-        return await get_hot_posts_query(session, limit, offset)
-        
-    # Ensure semantic_search also has joinedload(model.Posts.author)!
-    return await semantic_search(current_user.embedding, session, limit, offset)
+    # Users.embedding is deferred, fetch it only here
+    result = await session.execute(select(model.Users.embedding).where(model.Users.id == current_user.id))
+    user_embedding = result.scalar_one_or_none()
+    if user_embedding is None:
+        body = await get_hot_posts_query(session, limit, offset)
+    else:
+        body = await semantic_search(user_embedding, session, limit, offset)
+    return Response(content=body, media_type="application/json")
@@ -1,95 +1,229 @@
-from fastapi import APIRouter, status, HTTPException, Query, Depends, BackgroundTasks
-from asyncio import get_running_loop
+from fastapi import APIRouter, status, HTTPException, Query, Depends, BackgroundTasks, Request, Response
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from sqlmodel import select, desc, or_
+from sqlalchemy import insert
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import joinedload
-from app.encoder import encode_text
-from app import schemas, model, oauth2, utils
+from app.encoder import encode_text, encode_texts
+from app import schemas, model, oauth2, utils, projection, neighbors, duplicates, stats
+from app.db import read_session, async_session_factory
+import asyncio
+from app.cache import ResponseCache, post_cache, invalidate_post, publish_invalidation, json_response, make_etag
 from typing import List, Annotated
 
 
 router = APIRouter(prefix="/posts", tags=["Posts"])
 
+# Listing and per-user pages don't depend on who is asking
+POST_LIST_TTL = 5
+POST_LIST_STALE_TTL = 15
+post_list_cache = ResponseCache(ttl=POST_LIST_TTL, stale_ttl=POST_LIST_STALE_TTL, max_entries=4096)
 
-@router.get("/", response_model=List[schemas.Post_out], dependencies=[Depends(oauth2.get_current_user)])
-async def root(session: Annotated[AsyncSession, Depends(utils.get_db)],
+# Posts per model call and per INSERT in /posts/bulk
+BULK_BATCH_SIZE = 64
+
+
+@router.get("/", response_model=List[schemas.Post_out], dependencies=[Depends(oauth2.get_current_reader)])
+async def root(request: Request,
             limit: int = Query(default=10, gt=0, le=100, description="Maximum number of items to return"),
             offset: int = Query(default=0, ge=0, description="Number of items to skip"),
             search: str = Query(default="", description="Search term")):
-    
-    statement = select(model.Posts).filter(or_(model.Posts.content.like("%" + search + "%"), model.Posts.title.like("%" + search + "%")))\
-        .options(joinedload(model.Posts.author)).offset(offset).limit(limit)
-    result = await session.execute(statement)
-    posts = result.scalars().all()
-    return posts
-
-@router.get("/latest", response_model=schemas.Post_out, dependencies=[Depends(oauth2.get_current_user)])
-async def get_latest_post(session: Annotated[AsyncSession, Depends(utils.get_db)]):
-    statement = select(model.Posts).order_by(desc(model.Posts.created_at))
-    post_latest = await session.execute(statement)
-    return post_latest.scalars().first()
+
+    async def load_posts_page():
+        async with read_session() as session:
+            statement = projection.select_posts().filter(or_(model.Posts.content.like("%" + search + "%"), model.Posts.title.like("%" + search + "%")))\
+                .offset(offset).limit(limit)
+            return await projection.fetch_posts(session, statement)
+
+    return await post_list_cache.respond(request, ("list", limit, offset, search), load_posts_page)
+
+@router.get("/latest", response_model=schemas.Post_out, dependencies=[Depends(oauth2.get_current_reader)])
+async def get_latest_post(session: Annotated[AsyncSession, Depends(utils.get_read_db)]):
+    # Author joined in the projection: this session never loaded the author, a lazy load would fail
+    statement = projection.select_posts().order_by(desc(model.Posts.created_at)).limit(1)
+    row = (await session.execute(statement)).first()
+    if row is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No posts yet")
+    return Response(content=projection.dumps(projection.to_post(row)), media_type="application/json")
 
 @router.get("/me", response_model=List[schemas.Post_out])
-async def get_me_post(current_user: Annotated[schemas.User_out, Depends(oauth2.get_current_user)], session: Annotated[AsyncSession, Depends(utils.get_db)],
+async def get_me_post(current_user: Annotated[schemas.User_out, Depends(oauth2.get_current_reader)], session: Annotated[AsyncSession, Depends(utils.get_read_db)],
                     limit: int = Query(default=10, gt=0, le=100, description="Maximum number of items to return"),
                     offset: int = Query(default=0, ge=0, description="Number of items to skip")):
     
-    statement = select(model.Posts).where(model.Posts.author_id == current_user.id).offset(offset).limit(limit)
-    posts = await session.execute(statement)
-    return posts.scalars().all()
-
-@router.get("/{id}", response_model=schemas.Post_out, dependencies=[Depends(oauth2.get_current_user)])
-async def get_post_by_id(id: int, session: Annotated[AsyncSession, Depends(utils.get_db)]):
-    statement = select(model.Posts).where(model.Posts.id == id)
-    post = await session.execute(statement)
-    post = post.scalar_one_or_none()
-
-    if not post: 
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f'post with id: {id} not found.')
-    return post
-
-@router.get("/user/{user_id}", response_model=List[schemas.Post_out], dependencies=[Depends(oauth2.get_current_user)])
-async def get_user_posts(user_id: int, session: Annotated[AsyncSession, Depends(utils.get_db)],
+    statement = projection.select_posts().where(model.Posts.author_id == current_user.id).offset(offset).limit(limit)
+    body = await projection.fetch_posts(session, statement)
+    return Response(content=body, media_type="application/json")
+
+async def fetch_post_out(id: int, session: AsyncSession):
+    """Single round trip for a Post_out: only the columns it needs, author joined in."""
+    statement = projection.select_posts(model.Posts.modified_at).where(model.Posts.id == id)
+    return (await session.execute(statement)).one_or_none()
+
+def post_etag(row) -> str:
+    # modified_at moves on every UPDATE of the row (onupdate), votes/comments_count guard same-tick writes
+    modified = row.modified_at or row.created_at
+    return f'"{row.id}-{modified.timestamp():.6f}-{row.votes}-{row.comments_count}"'
+
+@router.get("/{id}", response_model=schemas.Post_out, dependencies=[Depends(oauth2.get_current_reader)])
+async def get_post_by_id(id: int, request: Request):
+
+    # Concurrent misses on the same id share this load inside the cache
+    async def load_post():
+        async with read_session(("post", id)) as session:
+            row = await fetch_post_out(id, session)
+
+            if not row: 
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                    detail=f'post with id: {id} not found.')
+            return projection.dumps(projection.to_post(row)), post_etag(row)
+
+    return await post_cache.respond(request, id, load_post)
+
+@router.get("/{id}/related", response_model=List[schemas.Post_out], dependencies=[Depends(oauth2.get_current_reader)])
+async def get_related_posts(id: int, request: Request):
+    """Precomputed neighbours (app.neighbors), empty until the post's list has been computed."""
+
+    async def load_related():
+        async with read_session(("post", id)) as session:
+            statement = projection.select_posts()\
+                .join(model.PostNeighbors, model.PostNeighbors.neighbor_id == model.Posts.id)\
+                .where(model.PostNeighbors.post_id == id)\
+                .order_by(model.PostNeighbors.rank)
+            return await projection.fetch_posts(session, statement)
+
+    return await post_list_cache.respond(request, ("related", id), load_related)
+
+@router.get("/user/{user_id}", response_model=List[schemas.Post_out])
+async def get_user_posts(user_id: int, request: Request,
+                        current_user: Annotated[schemas.User_out, Depends(oauth2.get_current_reader)],
                         limit: int = Query(default=10, gt=0, le=100, description="Maximum number of items to return"),
                         offset: int = Query(default=0, ge=0, description="Number of items to skip")):
-    # Check if user already exists
-    existing_user = await session.execute(select(model.Users).where(model.Users.id == user_id))
-    existing_user = existing_user.scalar_one_or_none()
-    if existing_user:
-        statement = select(model.Posts).where(model.Posts.author_id == user_id)\
-            .options(joinedload(model.Posts.author)).offset(offset).limit(limit)
-        posts = await session.execute(statement)
-        posts = posts.scalars().all()
-    else:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                        detail=f'User with id:{user_id} not found')
-
-    if not posts: 
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f'User with id:{user_id} hasn\'t posted anything yet')
-    return posts
 
+    async def load_user_posts():
+        async with read_session(("user", user_id)) as session:
+            # Check if user already exists
+            existing_user = await session.execute(select(model.Users.id).where(model.Users.id == user_id))
+            existing_user = existing_user.scalar_one_or_none()
+            if existing_user:
+                statement = projection.select_posts().where(model.Posts.author_id == user_id)\
+                    .offset(offset).limit(limit)
+                posts = await session.execute(statement)
+                posts = [projection.to_post(row) for row in posts]
+            else:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f'User with id:{user_id} not found')
+
+            if not posts: 
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                    detail=f'User with id:{user_id} hasn\'t posted anything yet')
+            return projection.dumps(posts)
+
+    if user_id == current_user.id:
+        # Authors see their own posts right after writing them: no shared page, and a read
+        # that stays on the primary while they are pinned
+        body = await load_user_posts()
+        return json_response(request, body, make_etag(body))
+    return await post_list_cache.respond(request, ("user", user_id, limit, offset), load_user_posts)
+
+
+def post_text(post: schemas.Post_in) -> str:
+    return f"Title: {post.title} | Content: {post.content}"
 
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=schemas.Post_out)
 async def create_posts(post: schemas.Post_in,
                         background_tasks: BackgroundTasks,
+                        response: Response,
                         current_user: Annotated[schemas.User_out, Depends(oauth2.get_current_user)], 
                         session: Annotated[AsyncSession, Depends(utils.get_db)]):
-    text_to_encode = f"Title: {post.title} | Content: {post.content}"
-
-    loop = get_running_loop()
-    embedding = await loop.run_in_executor(None, encode_text, text_to_encode)
-    new_post = model.Posts(title=post.title, content=post.content, author_id=current_user.id, published=post.published, embedding=embedding)
+    # The auth lookup's connection goes back to the pool while the model runs
+    embedding = await utils.run_in_executor(session, encode_text, post_text(post))
+    duplicate = await duplicates.find_duplicate(session, current_user.id, embedding)
+    if duplicate is not None:
+        if duplicates.DUPLICATE_MODE == "reject":
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Near-duplicate of post {duplicate.id}")
+        if duplicates.DUPLICATE_MODE == "merge" and duplicate.same_author:
+            response.status_code = status.HTTP_200_OK
+            return await session.get(model.Posts, duplicate.id)
+    new_post = model.Posts(title=post.title, content=post.content, author_id=current_user.id, published=post.published, embedding=embedding,
+                           duplicate_of=duplicate.root if duplicate else None)
     session.add(new_post)
+    await session.flush()
+    if duplicates.DUPLICATE_MODE == "off":
+        await duplicates.flag_posts(session, [new_post.id])
+    # Computed right after the response; the flag is the scheduler's fallback if that fails
+    await neighbors.flag_posts(session, [new_post.id])
+    await stats.bump(session, current_user.id, post_count=1)
     background_tasks.add_task(utils.run_background_update, current_user.id, embedding)
     await session.commit()
     await session.refresh(new_post)
+    background_tasks.add_task(neighbors.run_background_neighbors, new_post.id)
     return new_post
 
 
+async def insert_posts(author_id: int, posts: list, embeddings: list) -> list:
+    """One multi-row INSERT ... RETURNING for a batch, ids come back in input order."""
+    async with async_session_factory() as session:
+        session.info["user_id"] = author_id
+        statement = insert(model.Posts).returning(model.Posts.id, sort_by_parameter_order=True)
+        rows = [
+            {"title": post.title, "content": post.content, "author_id": author_id,
+             "published": post.published, "embedding": embedding}
+            for post, embedding in zip(posts, embeddings)
+        ]
+        result = await session.execute(statement, rows)
+        ids = result.scalars().all()
+        # The scheduler computes their related posts
+        await neighbors.flag_posts(session, ids)
+        await duplicates.flag_posts(session, ids)
+        await stats.bump(session, author_id, post_count=len(ids))
+        await session.commit()
+        return ids
+
+@router.post("/bulk", status_code=status.HTTP_200_OK)
+async def create_posts_bulk(bulk: schemas.Post_bulk_in,
+                            current_user: Annotated[schemas.User_out, Depends(oauth2.get_current_user)],
+                            session: Annotated[AsyncSession, Depends(utils.get_db)]):
+    """
+    Creates up to 1000 posts. Streams one NDJSON line per post ({"index", "id"} or {"index", "error"})
+    as each batch commits. Batches are encoded in one model call each, the next batch is encoded
+    while the previous one is inserted, and the author's embedding gets a single update at the end.
+    """
+    author_id = current_user.id
+    embeddings_done = []
+    # The stream uses its own sessions, don't keep the auth lookup's connection for its whole length
+    await utils.release_connection(session)
+    batches = [bulk.posts[i:i + BULK_BATCH_SIZE] for i in range(0, len(bulk.posts), BULK_BATCH_SIZE)]
+
+    def encode(batch):
+        return asyncio.ensure_future(utils.run_in_executor(None, encode_texts, [post_text(post) for post in batch]))
+
+    async def results():
+        next_encoding = encode(batches[0])
+        index = 0
+        try:
+            for n, batch in enumerate(batches):
+                embeddings = await next_encoding
+                next_encoding = encode(batches[n + 1]) if n + 1 < len(batches) else None
+                ids = await insert_posts(author_id, batch, embeddings)
+                embeddings_done.extend(embeddings)
+                for post_id in ids:
+                    yield projection.dumps({"index": index, "id": post_id}) + b"\n"
+                    index += 1
+        except Exception as error:
+            if next_encoding is not None:
+                next_encoding.cancel()
+            # Batches are committed one by one: report what was not stored and stop
+            for remaining in range(index, len(bulk.posts)):
+                yield projection.dumps({"index": remaining, "error": type(error).__name__}) + b"\n"
+
+    # Runs once the stream is over, with the embeddings of the batches that were stored
+    return StreamingResponse(results(), media_type="application/x-ndjson",
+                             background=BackgroundTask(utils.run_background_bulk_update, author_id, embeddings_done))
+
+
 @router.put("/{id}/edit", status_code=status.HTTP_200_OK, response_model=schemas.Post_out)
-async def update_post(post: schemas.Post_in, id: int, current_user: Annotated[schemas.User_out, Depends(oauth2.get_current_user)], session: Annotated[AsyncSession, Depends(utils.get_db)]):
+async def update_post(post: schemas.Post_in, id: int, background_tasks: BackgroundTasks, current_user: Annotated[schemas.User_out, Depends(oauth2.get_current_user)], session: Annotated[AsyncSession, Depends(utils.get_db)]):
     target_post = await session.get(model.Posts, id)
     if not target_post:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"post with id: {id} not found")
@@ -97,16 +231,21 @@ async def update_post(post: schemas.Post_in, id: int, current_user: Annotated[sc
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authorized to perform requested action")
     
     post_data = post.model_dump(exclude_unset=True) # Get only the fields provided
+    # Encode before touching target_post, a clean session can release its connection meanwhile
+    if "content" in post_data:
+        embedding = await utils.run_in_executor(session, encode_text, post_text(post))
+        setattr(target_post, "embedding", embedding)
+        # Posts that list this one were ranked against the old embedding
+        await neighbors.flag_neighbors_of(session, id)
+        await neighbors.flag_posts(session, [id])
+        background_tasks.add_task(neighbors.run_background_neighbors, id)
     for key, value in post_data.items():
-        if key == "content":
-            text_to_encode = f"Title: {post.title} | Content: {post.content}"
-            loop = get_running_loop()
-            embedding = await loop.run_in_executor(None, encode_text, text_to_encode)
-            setattr(target_post, "embedding", embedding)
         setattr(target_post, key, value)
 
     # 3. Commit the changes
+    await publish_invalidation(session, id)
     await session.commit()
+    invalidate_post(id)
     
     # 4. Refresh to ensure we have the latest (e.g., if there are DB triggers or default timestamps)
     await session.refresh(target_post)
@@ -123,5 +262,12 @@ async def delete_post(id: int, current_user: Annotated[schemas.User_out, Depends
     if current_user.id != post_del.author_id:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authorized to perform requested action")
     
+    # Their lists lose this post through the cascade, have them refilled
+    await neighbors.flag_neighbors_of(session, id)
+    await duplicates.reroot_cluster(session, id)
+    await stats.remove_post_comments(session, id)
+    await stats.bump(session, post_del.author_id, post_count=-1, post_karma=-post_del.votes)
     await session.delete(post_del)
+    await publish_invalidation(session, id)
     await session.commit()
+    invalidate_post(id)
@@ -0,0 +1,125 @@
+"""
+GET /search/typeahead: usernames and post titles containing what the user has typed so far.
+
+Matching is ILIKE '%q%', answered by the pg_trgm GIN indexes on users.username and
+posts.title (queries need 3 characters, shorter ones have no trigram to look up). Both kinds
+are fetched in one statement and ranked by where the match starts (prefixes first), then by
+length, so the ranking can be redone in Python. Common substrings are capped at
+TYPEAHEAD_CANDIDATES matches per probe; exact and prefix matches are probed separately so the
+cap never drops the best ones.
+
+Typing "alic" after "ali" mostly hits the cache: every match of "alic" also matches "ali",
+so when the cached answer for a shorter prefix was complete (fewer rows than asked for) the
+longer one is filtered out of it without a query.
+"""
+from collections import OrderedDict
+from fastapi import APIRouter, Depends, Query, Request
+from sqlalchemy import text
+from typing import List
+from dotenv import load_dotenv
+from app import schemas, oauth2, projection
+from app.db import read_session
+from app.cache import make_etag, json_response
+import os
+import time
+
+load_dotenv()
+
+TYPEAHEAD_MIN_LENGTH = 3
+TYPEAHEAD_TTL = float(os.getenv("TYPEAHEAD_TTL", "30"))
+TYPEAHEAD_CACHE_SIZE = int(os.getenv("TYPEAHEAD_CACHE_SIZE", "10000"))
+# Matches ranked per kind; bounds the work for very common substrings
+TYPEAHEAD_CANDIDATES = int(os.getenv("TYPEAHEAD_CANDIDATES", "200"))
+
+router = APIRouter(prefix="/search", tags=["Search"])
+
+# Candidates per kind come from three probes, best first: exact matches, prefix matches
+# (both cheap, few rows), then any substring match. An arbitrary cut of a common substring's
+# matches can no longer push "alice" out of the results for "alice".
+_typeahead = text("""
+    (SELECT 'user' AS type, id, text FROM (
+        (SELECT id, username AS text FROM users WHERE username ILIKE :exact LIMIT :limit)
+        UNION
+        (SELECT id, username FROM users WHERE username ILIKE :prefix LIMIT :candidates)
+        UNION
+        (SELECT id, username FROM users WHERE username ILIKE :pattern LIMIT :candidates)
+     ) AS users_found
+     ORDER BY strpos(lower(text), :q), length(text), id LIMIT :limit)
+    UNION ALL
+    (SELECT 'post' AS type, id, text FROM (
+        (SELECT id, title AS text FROM posts WHERE title ILIKE :exact LIMIT :limit)
+        UNION
+        (SELECT id, title FROM posts WHERE title ILIKE :prefix LIMIT :candidates)
+        UNION
+        (SELECT id, title FROM posts WHERE title ILIKE :pattern LIMIT :candidates)
+     ) AS posts_found
+     ORDER BY strpos(lower(text), :q), length(text), id LIMIT :limit)
+""")
+
+
+def normalize(q: str) -> str:
+    return " ".join(q.lower().split())
+
+def like_escape(q: str) -> str:
+    return q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def like_pattern(q: str) -> str:
+    return "%" + like_escape(q) + "%"
+
+def rank(q: str, rows: list, limit: int) -> list:
+    """Same order as the SQL: match position, length, id; both kinds mixed."""
+    return sorted(rows, key=lambda row: (row[2].lower().find(q), len(row[2]), row[1]))[:limit]
+
+
+class TypeaheadCache:
+    """(q, limit) -> (expires, rows, complete, body, etag), oldest first."""
+
+    def __init__(self):
+        self._entries: OrderedDict = OrderedDict()
+
+    def get(self, q: str, limit: int):
+        entry = self._entries.get((q, limit))
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end((q, limit))
+            return entry
+        return None
+
+    def narrow(self, q: str, limit: int):
+        """Answer for q from the complete answer of one of its prefixes, if there is one cached."""
+        for end in range(len(q) - 1, TYPEAHEAD_MIN_LENGTH - 1, -1):
+            entry = self.get(q[:end], limit)
+            if entry is not None and entry[2]:
+                rows = [row for row in entry[1] if q in row[2].lower()]
+                # A subset of a complete answer is complete; it expires with its source
+                return self.put(q, limit, rows, True, expires=entry[0])
+        return None
+
+    def put(self, q: str, limit: int, rows: list, complete: bool, expires: float | None = None):
+        body = projection.dumps([{"type": type, "id": id, "text": text} for type, id, text in rank(q, rows, limit)])
+        entry = (expires or time.monotonic() + TYPEAHEAD_TTL, rows, complete, body, make_etag(body))
+        self._entries[(q, limit)] = entry
+        self._entries.move_to_end((q, limit))
+        while len(self._entries) > TYPEAHEAD_CACHE_SIZE:
+            self._entries.popitem(last=False)
+        return entry
+
+typeahead_cache = TypeaheadCache()
+
+
+@router.get("/typeahead", response_model=List[schemas.Typeahead_out], dependencies=[Depends(oauth2.get_current_user_id)])
+async def typeahead(request: Request,
+                    q: str = Query(max_length=100),
+                    limit: int = Query(default=8, gt=0, le=20)):
+    q = normalize(q)
+    if len(q) < TYPEAHEAD_MIN_LENGTH:
+        return json_response(request, b"[]", make_etag(b"[]"), max_age=int(TYPEAHEAD_TTL))
+    entry = typeahead_cache.get(q, limit) or typeahead_cache.narrow(q, limit)
+    if entry is None:
+        async with read_session() as session:
+            result = await session.execute(_typeahead, {
+                "exact": like_escape(q), "prefix": like_escape(q) + "%", "pattern": like_pattern(q), "q": q, "limit": limit, "candidates": TYPEAHEAD_CANDIDATES
+            })
+            rows = [tuple(row) for row in result]
+        users = sum(1 for row in rows if row[0] == "user")
+        entry = typeahead_cache.put(q, limit, rows, users < limit and len(rows) - users < limit)
+    return json_response(request, entry[3], entry[4], max_age=int(TYPEAHEAD_TTL))
@@ -0,0 +1,28 @@
+from fastapi import APIRouter, status, HTTPException, Depends, Response
+from sqlmodel import select
+from sqlalchemy import func, lambda_stmt
+from app import schemas, model, oauth2, projection
+from app.db import read_session
+from app.stats import STAT_COLUMNS
+
+router = APIRouter(prefix="/users", tags=["Users"])
+
+def profile_lookup(user_id: int):
+    # Primary-key lookups of users and userstats; no stats row yet means no activity yet
+    return lambda_stmt(lambda: (
+        select(model.Users.id, model.Users.username, model.Users.created_at,
+               *[func.coalesce(column, 0).label(column.key) for column in STAT_COLUMNS])
+        .outerjoin(model.UserStats, model.UserStats.user_id == model.Users.id)
+        .where(model.Users.id == user_id)
+    ))
+
+@router.get("/{id}/profile", status_code=status.HTTP_200_OK, response_model=schemas.User_profile,
+            dependencies=[Depends(oauth2.get_current_user_id)])
+async def get_profile(id: int):
+    # The user's own writes pin them to the primary, so their profile is current right after
+    async with read_session(("user", id)) as session:
+        result = await session.execute(profile_lookup(id))
+        row = result.first()
+    if row is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"User with id: {id} not found")
+    return Response(content=projection.dumps(dict(row._mapping)), media_type="application/json")
@@ -1,7 +1,9 @@
 from fastapi import APIRouter, status, HTTPException, Depends, BackgroundTasks
 from sqlmodel import update, select
+from sqlalchemy import lambda_stmt
 from sqlalchemy.ext.asyncio import AsyncSession
-from app import schemas, model, oauth2, utils
+from app import schemas, model, oauth2, utils, trending, ratelimit, stats
+from app.cache import invalidate_post, publish_invalidation
 from typing import Annotated
 
 
@@ -9,7 +11,14 @@ router = APIRouter(prefix="/vote", tags=["Voting"])
 
 SUPER_VOTE_MULTIPLIER = 10
 
-@router.post("/{post_id}", status_code=status.HTTP_201_CREATED)
+def vote_lookup(user_id: int, post_id: int):
+    # Runs on every vote/unvote: cached lambda statement, no per-call SQL construction or compilation
+    return lambda_stmt(lambda: select(model.PostVotes).where(
+        model.PostVotes.post_id == post_id,
+        model.PostVotes.user_id == user_id
+    ))
+
+@router.post("/{post_id}", status_code=status.HTTP_201_CREATED, dependencies=[Depends(ratelimit.votes)])
 async def case_vote(post_id: int, vote_in: schemas.VoteCreate,
                     background_tasks: BackgroundTasks,
                     current_user: Annotated[schemas.User_out, Depends(oauth2.get_current_user)],
@@ -25,10 +34,7 @@ async def case_vote(post_id: int, vote_in: schemas.VoteCreate,
         )
 
     
-    statement = select(model.Votes).where(
-    model.Votes.user_id == current_user.id,
-    model.Votes.post_id == post_id
-)
+    statement = vote_lookup(current_user.id, post_id)
     result = await session.execute(statement)
     vote_target = result.scalar_one_or_none()
     if vote_target:
@@ -37,8 +43,7 @@ async def case_vote(post_id: int, vote_in: schemas.VoteCreate,
             detail="Already voted"
         )
 
-    if post_target.embedding:
-        background_tasks.add_task(utils.run_background_update, current_user.id, post_target.embedding)
+    background_tasks.add_task(utils.run_background_vote_update, current_user.id, post_id)
 
     # Handle Super Vote Balance Check
     if vote_in.is_super:
@@ -68,21 +73,24 @@ async def case_vote(post_id: int, vote_in: schemas.VoteCreate,
             .where(model.Posts.id == post_id)
             .values(votes=model.Posts.votes + change)
         )
+    await trending.record_vote(session, post_id, change)
+    await stats.bump(session, post_target.author_id, post_karma=change)
 
     # Create new vote
-    new_vote = model.Votes(
+    new_vote = model.PostVotes(
         user_id=current_user.id, 
         post_id=post_id, 
         direction=vote_in.direction, 
-        is_super=vote_in.is_super,
-        comment_id=None
+        is_super=vote_in.is_super
     )
     session.add(new_vote)
+    await publish_invalidation(session, post_id)
     await session.commit()
+    invalidate_post(post_id)
         
 
 
-@router.delete("/{post_id}", status_code=status.HTTP_204_NO_CONTENT)
+@router.delete("/{post_id}", status_code=status.HTTP_204_NO_CONTENT, dependencies=[Depends(ratelimit.votes)])
 async def delete_vote(post_id: int,
                     current_user: Annotated[schemas.User_out, Depends(oauth2.get_current_user)],
                     session: Annotated[AsyncSession, Depends(utils.get_db)]):
@@ -94,10 +102,7 @@ async def delete_vote(post_id: int,
             detail=f"Post with id: {post_id} not found"
         )
     
-    statement = select(model.Votes).where(
-    model.Votes.user_id == current_user.id,
-    model.Votes.post_id == post_id
-    )
+    statement = vote_lookup(current_user.id, post_id)
     result = await session.execute(statement)
     vote_target = result.scalar_one_or_none()
     if not vote_target:
@@ -116,6 +121,8 @@ async def delete_vote(post_id: int,
         .where(model.Posts.id == post_id)
         .values(votes=model.Posts.votes - change)
     )
+    await trending.record_vote(session, post_id, -change, at=vote_target.created_at)
+    await stats.bump(session, post_target.author_id, post_karma=-change)
     
     # Refund super vote if applicable
     if vote_target.is_super:
@@ -127,4 +134,6 @@ async def delete_vote(post_id: int,
         )
     
     await session.delete(vote_target)
-    await session.commit()
\ No newline at end of file
+    await publish_invalidation(session, post_id)
+    await session.commit()
+    invalidate_post(post_id)
\ No newline at end of file
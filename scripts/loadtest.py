@@ -0,0 +1,226 @@
+"""
+Replays a realistic traffic mix against the ASGI app in-process (no server, no network).
+
+    python -m scripts.loadtest --users 10000 --posts 50000 --concurrency 50 --duration 60 --output run.json
+    python -m scripts.loadtest ... --compare run.json
+
+Expects a database seeded by scripts.seed with the same --users/--posts/--password. Each
+virtual user logs in, then picks actions from the weighted --mix until --duration runs
+out; posts are picked with the same hot-post skew as the seed. Reported per action:
+throughput, p50/p99 latency seen by the client and, per route, SQL statements and time
+taken from app.instrumentation. The JSON written by --output can be given back to
+--compare to print the change run over run.
+
+The in-process transport returns once the app call is over, so client latency includes
+BackgroundTasks (vote embedding update); the server-side numbers stop at the last byte.
+
+Rate limits (app.ratelimit) are off unless RATE_LIMIT_ENABLED is set: every in-process client
+comes from the same address (127.0.0.1), so the per-IP login limit would let only a handful
+of virtual users in and the rest would count 429s and 401s as errors.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from collections import defaultdict
+import httpx
+import numpy as np
+
+# Read by app.ratelimit at import time
+os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+
+from app.main import app
+from app.instrumentation import request_db_statements, request_db_seconds
+from scripts.seed import WORDS, skewed_ids
+
+DEFAULT_MIX = "hot=25,post=20,comments=15,personalized=10,similar=5,browse=5,user_posts=5,vote=8,comment=5,login=2"
+
+
+class VirtualUser:
+    def __init__(self, client: httpx.AsyncClient, args, post_ids: np.ndarray, record):
+        self.client = client
+        self.args = args
+        self.post_ids = post_ids
+        self.record = record
+        self.user_id = random.randint(1, args.users)
+        self.headers = {}
+
+    def post_id(self) -> int:
+        return int(self.post_ids[random.randrange(len(self.post_ids))])
+
+    async def call(self, action: str, method: str, url: str, **kwargs) -> httpx.Response:
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, headers=self.headers, **kwargs)
+        except Exception:
+            self.record(action, time.perf_counter() - start, ok=False)
+            raise
+        # 409 on a vote that already exists is part of the scenario, not a failure
+        self.record(action, time.perf_counter() - start, ok=response.status_code < 400 or response.status_code == 409)
+        return response
+
+    async def login(self):
+        response = await self.call("login", "POST", "/auth/token",
+                                   data={"username": f"user{self.user_id}", "password": self.args.password})
+        if response.status_code == 200:
+            self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    async def hot(self):
+        await self.call("hot", "GET", "/feed/hot", params={"offset": random.choice((0, 0, 0, 10, 20))})
+
+    async def post(self):
+        await self.call("post", "GET", f"/posts/{self.post_id()}")
+
+    async def comments(self):
+        await self.call("comments", "GET", f"/comments/{self.post_id()}")
+
+    async def personalized(self):
+        await self.call("personalized", "GET", "/feed/personalized")
+
+    async def similar(self):
+        await self.call("similar", "GET", f"/feed/similar/{' '.join(random.sample(WORDS, 2))}")
+
+    async def browse(self):
+        await self.call("browse", "GET", "/posts/", params={"offset": random.choice((0, 10, 20))})
+
+    async def user_posts(self):
+        await self.call("user_posts", "GET", f"/posts/user/{random.randint(1, self.args.users)}")
+
+    async def vote(self):
+        post_id = self.post_id()
+        response = await self.call("vote", "POST", f"/vote/{post_id}", json={"direction": random.choice((1, 1, 1, -1))})
+        if response.status_code == 409:
+            await self.call("unvote", "DELETE", f"/vote/{post_id}")
+
+    async def comment(self):
+        await self.call("comment", "POST", f"/comments/{self.post_id()}/create",
+                        json={"content": " ".join(random.choices(WORDS, k=12))})
+
+    async def run(self, actions: list, weights: list, deadline: float):
+        await self.login()
+        while time.perf_counter() < deadline:
+            action = random.choices(actions, weights)[0]
+            await getattr(self, action)()
+
+
+def parse_mix(mix: str) -> dict:
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if not hasattr(VirtualUser, name.strip()) or name.strip() in ("call", "run", "post_id"):
+            raise SystemExit(f"unknown action in --mix: {name}")
+        weights[name.strip()] = float(weight)
+    return weights
+
+def db_snapshot() -> dict:
+    routes = app.openapi()["paths"]
+    return {
+        path: (request_db_statements.count(route=path), request_db_statements.sum(route=path), request_db_seconds.sum(route=path))
+        for path in routes
+    }
+
+
+async def run(args) -> dict:
+    random.seed(args.seed)
+    post_ids = skewed_ids(np.random.default_rng(args.seed), args.posts, 100_000, args.skew)
+    mix = parse_mix(args.mix)
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+
+    def record(action: str, elapsed: float, ok: bool):
+        latencies[action].append(elapsed)
+        if not ok:
+            errors[action] += 1
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=60) as client:
+            before = db_snapshot()
+            start = time.perf_counter()
+            deadline = start + args.duration
+            users = [VirtualUser(client, args, post_ids, record) for _ in range(args.concurrency)]
+            await asyncio.gather(*(user.run(list(mix), list(mix.values()), deadline) for user in users))
+            elapsed = time.perf_counter() - start
+            after = db_snapshot()
+
+    actions = {}
+    for action, values in sorted(latencies.items()):
+        values = np.array(values) * 1000
+        actions[action] = {
+            "requests": len(values),
+            "errors": errors[action],
+            "rps": round(len(values) / elapsed, 2),
+            "p50_ms": round(float(np.percentile(values, 50)), 2),
+            "p99_ms": round(float(np.percentile(values, 99)), 2),
+        }
+    routes = {}
+    for path, (count, statements, seconds) in after.items():
+        requests = count - before[path][0]
+        if requests:
+            routes[path] = {
+                "requests": requests,
+                "db_statements_per_request": round((statements - before[path][1]) / requests, 2),
+                "db_ms_per_request": round((seconds - before[path][2]) * 1000 / requests, 2),
+            }
+    total = sum(len(values) for values in latencies.values())
+    return {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "duration_s": round(elapsed, 2),
+        "requests": total,
+        "rps": round(total / elapsed, 2),
+        "actions": actions,
+        "routes": routes,
+    }
+
+
+def change(new: float, old: float) -> str:
+    return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+
+def report(result: dict, previous: dict | None):
+    print(f"\n{result['requests']} requests in {result['duration_s']}s, {result['rps']} req/s"
+          + (f" ({change(result['rps'], previous['rps'])})" if previous else ""))
+    print(f"\n{'action':<14}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for action, stats in result["actions"].items():
+        line = f"{action:<14}{stats['requests']:>10}{stats['errors']:>8}{stats['rps']:>10}{stats['p50_ms']:>10}{stats['p99_ms']:>10}"
+        old = previous["actions"].get(action) if previous else None
+        if old:
+            line += f"   p50 {change(stats['p50_ms'], old['p50_ms'])}  p99 {change(stats['p99_ms'], old['p99_ms'])}"
+        print(line)
+    print(f"\n{'route':<32}{'requests':>10}{'SQL/req':>10}{'SQL ms/req':>12}")
+    for path, stats in sorted(result["routes"].items()):
+        line = f"{path:<32}{stats['requests']:>10}{stats['db_statements_per_request']:>10}{stats['db_ms_per_request']:>12}"
+        old = previous["routes"].get(path) if previous else None
+        if old:
+            line += f"   SQL/req {change(stats['db_statements_per_request'], old['db_statements_per_request'])}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10_000, help="seeded users to log in as")
+    parser.add_argument("--posts", type=int, default=50_000, help="seeded posts to read and vote on")
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--concurrency", type=int, default=50, help="virtual users")
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="action=weight,...")
+    parser.add_argument("--skew", type=float, default=1.1)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--compare", help="JSON of a previous run to compare against")
+    args = parser.parse_args()
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    result = asyncio.run(run(args))
+    report(result, previous)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+Online schema changes on tables that already exist: create_all only creates missing
+tables, it never adds a column or an index to one that is there.
+
+    python -m scripts.migrate_schema             # before deploying: columns, tables, indexes, backfills
+    python -m scripts.migrate_schema --finish    # once no old worker is left
+
+Order of a deploy:
+1. Run this with the old code still serving. Columns are added without a default (a catalog
+   change only) under a short lock_timeout, foreign keys NOT VALID then validated without
+   blocking writes, indexes are built CONCURRENTLY. Backfills run in id batches, each its own
+   short transaction. Everything is idempotent: an interrupted run is simply started again.
+2. Deploy the new code. Old workers still create posts without the duplicate probe, a
+   trigger queues them for the scheduler until --finish.
+3. --finish drops that trigger and recomputes the user stats once: writes made by old workers
+   during the rollout never bumped them.
+"""
+import argparse
+import asyncio
+import time
+import asyncpg
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateTable, CreateIndex
+from app import model
+from scripts.seed import connect_url
+from scripts.migrate_votes import ddl
+
+# user-047: posts created by old workers, which don't probe, go to the scheduler's queue
+QUEUE_UNPROBED = """
+CREATE OR REPLACE FUNCTION posts_duplicates_pending() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO postduplicatespending (post_id) VALUES (NEW.id) ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS posts_duplicates_pending ON posts;
+CREATE TRIGGER posts_duplicates_pending AFTER INSERT ON posts FOR EACH ROW EXECUTE FUNCTION posts_duplicates_pending();
+"""
+
+BACKFILL_PENDING = """
+INSERT INTO postduplicatespending (post_id)
+SELECT id FROM posts WHERE id >= $1 AND id < $2 ORDER BY id
+ON CONFLICT DO NOTHING
+"""
+
+# user-048: rows already there were created by bumps, the reconcile in --finish fixes those
+BACKFILL_STATS = """
+INSERT INTO userstats (user_id, post_count, comment_count, post_karma, comment_karma)
+SELECT u.id, coalesce(p.posts, 0), coalesce(c.comments, 0), coalesce(p.karma, 0), coalesce(c.karma, 0)
+FROM users AS u
+LEFT JOIN LATERAL (
+    SELECT count(*) AS posts, sum(votes) AS karma FROM posts WHERE author_id = u.id
+) AS p ON true
+LEFT JOIN LATERAL (
+    SELECT count(*) FILTER (WHERE NOT is_deleted) AS comments, sum(votes) AS karma FROM comments WHERE user_id = u.id
+) AS c ON true
+WHERE u.id >= $1 AND u.id < $2
+ORDER BY u.id
+ON CONFLICT DO NOTHING
+"""
+
+
+def create_table(table) -> str:
+    return str(CreateTable(table, if_not_exists=True).compile(dialect=postgresql.dialect()))
+
+def create_index(index) -> str:
+    return str(CreateIndex(index, if_not_exists=True).compile(dialect=postgresql.dialect()))
+
+def model_index(table, name: str):
+    return next(index for index in table.indexes if index.name == name)
+
+
+async def create_index_concurrently(conn, index):
+    """CREATE INDEX CONCURRENTLY: reads and writes go on while it builds, it only waits for them."""
+    # A failed concurrent build leaves an INVALID index behind that IF NOT EXISTS would keep
+    invalid = await conn.fetchval(
+        "SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1)", index.name
+    )
+    if invalid:
+        print(f"{index.name}: dropping an invalid build")
+        await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index.name}")
+    start = time.perf_counter()
+    await conn.execute(create_index(index).replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY", 1))
+    print(f"{index.name} built in {time.perf_counter() - start:.1f}s")
+
+async def add_foreign_key(conn, table: str, name: str, definition: str):
+    """NOT VALID takes the lock only briefly; VALIDATE scans under a lock that lets writes through."""
+    exists = await conn.fetchval("SELECT true FROM pg_constraint WHERE conname = $1", name)
+    if not exists:
+        await ddl(conn, f"ALTER TABLE {table} ADD CONSTRAINT {name} FOREIGN KEY {definition} NOT VALID")
+    await conn.execute(f"ALTER TABLE {table} VALIDATE CONSTRAINT {name}")
+
+async def backfill(conn, table: str, statement: str, batch: int, pause: float):
+    low, high = await conn.fetchrow(f"SELECT min(id), max(id) FROM {table}")
+    if low is None:
+        return
+    start = time.perf_counter()
+    for first in range(low, high + 1, batch):
+        async with conn.transaction():
+            await conn.execute(statement, first, first + batch)
+        print(f"\r{table}: {min(first + batch, high + 1) - low:,}/{high + 1 - low:,} ids", end="", flush=True)
+        if pause:
+            await asyncio.sleep(pause)
+    print(f"\r{table} backfilled in {time.perf_counter() - start:.1f}s")
+
+
+async def migrate_duplicates(conn, args):
+    """user-047: Posts.duplicate_of and the queue of posts the scheduler still has to probe."""
+    await ddl(conn, "ALTER TABLE posts ADD COLUMN IF NOT EXISTS duplicate_of integer")
+    await add_foreign_key(conn, "posts", "posts_duplicate_of_fkey",
+                          "(duplicate_of) REFERENCES posts (id) ON DELETE SET NULL")
+    await create_index_concurrently(conn, model_index(model.Posts.__table__, "ix_posts_duplicate_of"))
+    await ddl(conn, create_table(model.PostDuplicatesPending.__table__))
+    # Trigger first: a post inserted while the backfill runs is queued by one or the other
+    await ddl(conn, QUEUE_UNPROBED)
+    await backfill(conn, "posts", BACKFILL_PENDING, args.batch, args.pause)
+
+async def migrate_search(conn):
+    """user-045: trigram indexes behind the typeahead, without them every keystroke is a seq scan."""
+    await conn.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    await create_index_concurrently(conn, model_index(model.Users.__table__, "ix_users_username_trgm"))
+    await create_index_concurrently(conn, model_index(model.Posts.__table__, "ix_posts_title_trgm"))
+
+async def migrate_stats(conn, args):
+    """user-048: a profile is only right if its userstats row started from the real totals."""
+    await ddl(conn, create_table(model.UserStats.__table__))
+    await backfill(conn, "users", BACKFILL_STATS, args.batch, args.pause)
+
+
+async def finish():
+    from app.db import engine
+    from app.stats import reconcile_stats
+    try:
+        print("reconciling user stats...")
+        await reconcile_stats()
+    finally:
+        await engine.dispose()
+
+async def migrate(args):
+    conn = await asyncpg.connect(connect_url())
+    try:
+        if args.finish:
+            await ddl(conn, "DROP TRIGGER IF EXISTS posts_duplicates_pending ON posts")
+            await ddl(conn, "DROP FUNCTION IF EXISTS posts_duplicates_pending()")
+        else:
+            await migrate_duplicates(conn, args)
+            await migrate_search(conn)
+            await migrate_stats(conn, args)
+            await conn.execute("ANALYZE posts")
+            await conn.execute("ANALYZE users")
+            await conn.execute("ANALYZE userstats")
+    finally:
+        await conn.close()
+    if args.finish:
+        await finish()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch", type=int, default=10_000, help="ids backfilled per transaction")
+    parser.add_argument("--pause", type=float, default=0.05, help="seconds between batches, keeps replication lag down")
+    parser.add_argument("--finish", action="store_true", help="drop the rollout trigger and reconcile the user stats")
+    args = parser.parse_args()
+    asyncio.run(migrate(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+Online move of the old single `votes` table into the partitioned postvotes / commentvotes.
+
+    python -m scripts.migrate_votes                  # tables, mirror trigger, backfill, verify
+    python -m scripts.migrate_votes --finish         # after every worker runs the new code
+
+Order of a deploy:
+1. Run this with the old code still serving. It creates the new tables, then a trigger on
+   `votes` that copies every insert and delete to them, then backfills the existing rows in
+   id batches (each its own short transaction, --pause between them), then adds the reverse
+   triggers (new tables -> `votes`) and compares counts.
+2. Deploy the code that reads and writes postvotes / commentvotes. While old and new workers
+   both serve, every vote is in both places: each side's "Already voted" check and unvote
+   see the other side's votes, so no vote is counted twice.
+3. --finish drops the triggers and `votes`, once no old worker is left.
+
+A backfill batch locks the rows it copies (FOR SHARE), so a vote deleted while its batch
+runs waits for it and is then removed from the new table by the trigger: nothing deleted
+comes back. DDL runs with a short lock_timeout and is retried, so it never queues traffic
+behind a long transaction.
+"""
+import argparse
+import asyncio
+import time
+import asyncpg
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateTable, CreateIndex
+from app import model
+from scripts.seed import connect_url
+
+# Mirrored writes don't bounce back: a trigger fired by another trigger (depth > 1) does nothing
+MIRROR = """
+CREATE OR REPLACE FUNCTION votes_mirror() RETURNS trigger AS $$
+BEGIN
+    IF pg_trigger_depth() > 1 THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'DELETE' THEN
+        IF OLD.post_id IS NOT NULL THEN
+            DELETE FROM postvotes WHERE post_id = OLD.post_id AND user_id = OLD.user_id;
+        ELSIF OLD.comment_id IS NOT NULL THEN
+            DELETE FROM commentvotes WHERE comment_id = OLD.comment_id AND user_id = OLD.user_id;
+        END IF;
+        RETURN NULL;
+    END IF;
+    IF NEW.post_id IS NOT NULL THEN
+        INSERT INTO postvotes (post_id, user_id, direction, is_super, created_at)
+        VALUES (NEW.post_id, NEW.user_id, NEW.direction, NEW.is_super, NEW.created_at) ON CONFLICT DO NOTHING;
+    ELSIF NEW.comment_id IS NOT NULL THEN
+        INSERT INTO commentvotes (comment_id, user_id, direction, is_super, created_at)
+        VALUES (NEW.comment_id, NEW.user_id, NEW.direction, NEW.is_super, NEW.created_at) ON CONFLICT DO NOTHING;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS votes_mirror ON votes;
+CREATE TRIGGER votes_mirror AFTER INSERT OR DELETE ON votes FOR EACH ROW EXECUTE FUNCTION votes_mirror();
+"""
+
+# The other direction, for the rollout: votes cast on new workers must be seen by old workers,
+# or their "Already voted" check passes and the vote is counted twice
+MIRROR_BACK = """
+CREATE OR REPLACE FUNCTION votes_mirror_back() RETURNS trigger AS $$
+BEGIN
+    IF pg_trigger_depth() > 1 THEN
+        RETURN NULL;
+    END IF;
+    IF TG_TABLE_NAME = 'postvotes' THEN
+        IF TG_OP = 'DELETE' THEN
+            DELETE FROM votes WHERE user_id = OLD.user_id AND post_id = OLD.post_id;
+        ELSE
+            INSERT INTO votes (user_id, post_id, direction, is_super, created_at)
+            VALUES (NEW.user_id, NEW.post_id, NEW.direction, NEW.is_super, NEW.created_at) ON CONFLICT DO NOTHING;
+        END IF;
+    ELSE
+        IF TG_OP = 'DELETE' THEN
+            DELETE FROM votes WHERE user_id = OLD.user_id AND comment_id = OLD.comment_id;
+        ELSE
+            INSERT INTO votes (user_id, comment_id, direction, is_super, created_at)
+            VALUES (NEW.user_id, NEW.comment_id, NEW.direction, NEW.is_super, NEW.created_at) ON CONFLICT DO NOTHING;
+        END IF;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS votes_mirror_back ON postvotes;
+CREATE TRIGGER votes_mirror_back AFTER INSERT OR DELETE ON postvotes FOR EACH ROW EXECUTE FUNCTION votes_mirror_back();
+DROP TRIGGER IF EXISTS votes_mirror_back ON commentvotes;
+CREATE TRIGGER votes_mirror_back AFTER INSERT OR DELETE ON commentvotes FOR EACH ROW EXECUTE FUNCTION votes_mirror_back();
+"""
+
+BACKFILL_POSTS = """
+INSERT INTO postvotes (post_id, user_id, direction, is_super, created_at)
+SELECT post_id, user_id, direction, is_super, created_at FROM votes
+WHERE id >= $1 AND id < $2 AND post_id IS NOT NULL
+FOR SHARE
+ON CONFLICT DO NOTHING
+"""
+BACKFILL_COMMENTS = """
+INSERT INTO commentvotes (comment_id, user_id, direction, is_super, created_at)
+SELECT comment_id, user_id, direction, is_super, created_at FROM votes
+WHERE id >= $1 AND id < $2 AND comment_id IS NOT NULL
+FOR SHARE
+ON CONFLICT DO NOTHING
+"""
+
+
+async def ddl(conn, statement: str, attempts: int = 20):
+    """DDL under lock_timeout: give up the lock wait quickly and try again rather than block writers."""
+    for attempt in range(attempts):
+        try:
+            async with conn.transaction():
+                await conn.execute("SET LOCAL lock_timeout = '2s'")
+                await conn.execute(statement)
+            return
+        except asyncpg.LockNotAvailableError:
+            print(f"lock not available, retrying ({attempt + 1}/{attempts})")
+            await asyncio.sleep(1 + attempt)
+    raise RuntimeError("could not get the lock for: " + statement.strip().splitlines()[0])
+
+
+def tables_ddl() -> list[str]:
+    """CREATE statements of the new tables, indexes and partitions, one lock at a time."""
+    statements = []
+    for table in (model.PostVotes.__table__, model.CommentVotes.__table__):
+        # The FKs take SHARE ROW EXCLUSIVE on posts / comments / users: each statement goes through ddl()
+        statements.append(str(CreateTable(table, if_not_exists=True).compile(dialect=postgresql.dialect())))
+        statements.extend(str(CreateIndex(index, if_not_exists=True).compile(dialect=postgresql.dialect()))
+                          for index in table.indexes)
+        statements.extend(model.vote_partitions_ddl(table))
+    return statements
+
+
+async def backfill(conn, batch: int, pause: float):
+    low, high = await conn.fetchrow("SELECT min(id), max(id) FROM votes")
+    if low is None:
+        return
+    # Rows above `high` were inserted after the trigger existed, it copied them already
+    start = time.perf_counter()
+    for first in range(low, high + 1, batch):
+        async with conn.transaction():
+            await conn.execute(BACKFILL_POSTS, first, first + batch)
+            await conn.execute(BACKFILL_COMMENTS, first, first + batch)
+        print(f"\rvotes: {min(first + batch, high + 1) - low:,}/{high + 1 - low:,} ids", end="", flush=True)
+        if pause:
+            await asyncio.sleep(pause)
+    print(f"\rvotes backfilled in {time.perf_counter() - start:.1f}s")
+
+
+async def verify(conn) -> bool:
+    old_posts, old_comments = await conn.fetchrow(
+        "SELECT count(*) FILTER (WHERE post_id IS NOT NULL), count(*) FILTER (WHERE comment_id IS NOT NULL) FROM votes"
+    )
+    new_posts = await conn.fetchval("SELECT count(*) FROM postvotes")
+    new_comments = await conn.fetchval("SELECT count(*) FROM commentvotes")
+    print(f"post votes: {old_posts:,} -> {new_posts:,}, comment votes: {old_comments:,} -> {new_comments:,}")
+    # Votes keep being cast while this runs; only a persistent difference means something is wrong
+    return old_posts == new_posts and old_comments == new_comments
+
+
+async def migrate(args):
+    conn = await asyncpg.connect(connect_url())
+    try:
+        if args.finish:
+            await ddl(conn, "DROP TRIGGER IF EXISTS votes_mirror_back ON postvotes")
+            await ddl(conn, "DROP TRIGGER IF EXISTS votes_mirror_back ON commentvotes")
+            await ddl(conn, "DROP FUNCTION IF EXISTS votes_mirror_back()")
+            await ddl(conn, "DROP TRIGGER IF EXISTS votes_mirror ON votes")
+            await ddl(conn, "DROP FUNCTION IF EXISTS votes_mirror()")
+            await ddl(conn, "DROP TABLE IF EXISTS votes")
+            print("votes dropped")
+            return
+        for statement in tables_ddl():
+            await ddl(conn, statement)
+        await ddl(conn, MIRROR)
+        await backfill(conn, args.batch, args.pause)
+        await ddl(conn, MIRROR_BACK)
+        await conn.execute("ANALYZE postvotes")
+        await conn.execute("ANALYZE commentvotes")
+        if not await verify(conn):
+            print("counts differ: run again once traffic is quiet, the backfill is idempotent")
+    finally:
+        await conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch", type=int, default=10_000, help="votes ids copied per transaction")
+    parser.add_argument("--pause", type=float, default=0.05, help="seconds between batches, keeps replication lag down")
+    parser.add_argument("--finish", action="store_true", help="drop the trigger and the old votes table")
+    args = parser.parse_args()
+    asyncio.run(migrate(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""
+Seeds a local Postgres + pgvector with a synthetic but production-shaped dataset.
+
+    python -m scripts.seed --users 1000000 --posts 3000000 --votes 20000000 --comments 5000000
+
+Every table is loaded with COPY (binary, through asyncpg) in chunks, with explicit ids so
+votes and comments can reference rows without a round trip. Shape of the data:
+- posts and votes follow a Zipf-like popularity curve, a few posts get most of the traffic
+- comments form deep trees, a reply usually answers one of the latest comments of the thread
+- embeddings come from the real model, or with --skip-model from random unit vectors
+  scattered around topic centroids (so ANN search still sees clusters)
+Every seeded user has the password given by --password.
+"""
+import argparse
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+import asyncpg
+import numpy as np
+from pgvector.asyncpg import register_vector
+from sqlalchemy import make_url
+from sqlmodel import SQLModel
+from app.db import DATABASE_URL, engine, initialize_vector_extension
+from app import utils
+
+WORDS = (
+    "python postgres vector search async api cache latency index query feed vote comment "
+    "model embedding cluster replica pool thread event loop worker queue stream batch "
+    "music travel football cooking movies science space history games photography books"
+).split()
+DIMENSIONS = 384
+CHUNK = 50_000
+
+
+def connect_url() -> str:
+    # asyncpg wants a plain postgresql:// url
+    return make_url(DATABASE_URL).set(drivername="postgresql").render_as_string(hide_password=False)
+
+def skewed_ids(rng, n_items: int, size: int, skew: float) -> np.ndarray:
+    """ids in 1..n_items, id k drawn with probability ~ 1/k^skew (id 1 is the hottest)."""
+    weights = 1.0 / np.arange(1, n_items + 1) ** skew
+    return rng.choice(n_items, size=size, p=weights / weights.sum()) + 1
+
+def sentence(rng, n_words: int) -> str:
+    return " ".join(rng.choice(WORDS, size=n_words))
+
+def random_embeddings(rng, centroids, size: int) -> np.ndarray:
+    topics = rng.integers(0, len(centroids), size=size)
+    vectors = centroids[topics] + rng.normal(scale=0.5 / np.sqrt(DIMENSIONS), size=(size, DIMENSIONS))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors.astype(np.float32)
+
+def timestamps(rng, now: datetime, days: int, size: int) -> list:
+    seconds = rng.uniform(0, days * 86400, size=size)
+    return [now - timedelta(seconds=float(s)) for s in seconds]
+
+
+async def copy_chunks(conn, table: str, columns: tuple, chunks, total: int):
+    start = time.perf_counter()
+    done = 0
+    for records in chunks:
+        await conn.copy_records_to_table(table, records=records, columns=columns)
+        done += len(records)
+        print(f"\r{table}: {done:,}/{total:,}", end="", flush=True)
+    print(f"\r{table}: {done:,} rows in {time.perf_counter() - start:.1f}s")
+
+
+def user_chunks(args, rng, centroids, password_hash, now):
+    for first in range(1, args.users + 1, CHUNK):
+        ids = range(first, min(first + CHUNK, args.users + 1))
+        embeddings = random_embeddings(rng, centroids, len(ids))
+        created = timestamps(rng, now, args.days * 2, len(ids))
+        yield [
+            (i, f"user{i}", f"user{i}@example.com", password_hash, 5, created[n], embeddings[n])
+            for n, i in enumerate(ids)
+        ]
+
+def post_chunks(args, rng, centroids, encode, now):
+    for first in range(1, args.posts + 1, CHUNK):
+        ids = range(first, min(first + CHUNK, args.posts + 1))
+        titles = [sentence(rng, int(rng.integers(3, 9))) for _ in ids]
+        contents = [sentence(rng, int(rng.integers(20, 80))) for _ in ids]
+        authors = skewed_ids(rng, args.users, len(ids), 0.8)
+        created = timestamps(rng, now, args.days, len(ids))
+        if encode is not None:
+            embeddings = encode([f"{t} {c}" for t, c in zip(titles, contents)])
+        else:
+            embeddings = random_embeddings(rng, centroids, len(ids))
+        yield [
+            (i, titles[n], contents[n], int(authors[n]), True, 0, 0, created[n], created[n], embeddings[n])
+            for n, i in enumerate(ids)
+        ]
+
+def vote_chunks(args, rng, now):
+    # (user_id, post_id) is unique: draw with the hot-post skew, then drop repeated pairs
+    seen = np.empty(0, dtype=np.int64)
+    for first in range(0, args.votes, CHUNK):
+        size = min(CHUNK, args.votes - first)
+        users = rng.integers(1, args.users + 1, size=size)
+        posts = skewed_ids(rng, args.posts, size, args.skew)
+        keys = np.unique(users.astype(np.int64) * (args.posts + 1) + posts)
+        keys = keys[~np.isin(keys, seen, assume_unique=True)]
+        seen = np.union1d(seen, keys)
+        directions = np.where(rng.random(len(keys)) < 0.8, 1, -1)
+        created = timestamps(rng, now, args.days, len(keys))
+        yield [(key // (args.posts + 1), key % (args.posts + 1), int(directions[n]), False, created[n])
+               for n, key in enumerate(keys.tolist())]
+
+def comment_chunks(args, rng, now):
+    posts = skewed_ids(rng, args.posts, args.comments, args.skew)
+    posts.sort()
+    users = rng.integers(1, args.users + 1, size=args.comments)
+    created_offsets = np.sort(rng.uniform(0, args.days * 86400, size=args.comments))[::-1]
+    records = []
+    thread: list = []
+    for i in range(args.comments):
+        comment_id = i + 1
+        post_id = int(posts[i])
+        if i == 0 or post_id != posts[i - 1]:
+            thread = []
+        parent_id = None
+        if thread and rng.random() < args.reply_ratio:
+            # replies mostly go to the newest comments, which makes long chains
+            parent_id = thread[-1 - min(int(rng.geometric(0.5)) - 1, len(thread) - 1)]
+        thread.append(comment_id)
+        created = now - timedelta(seconds=float(created_offsets[i]))
+        records.append((comment_id, sentence(rng, int(rng.integers(5, 30))), int(users[i]), post_id,
+                        parent_id, 0, False, created, created))
+        if len(records) == CHUNK:
+            yield records
+            records = []
+    if records:
+        yield records
+
+
+async def seed(args):
+    async with engine.begin() as conn:
+        await initialize_vector_extension(engine)
+        await conn.run_sync(SQLModel.metadata.create_all)
+    await engine.dispose()
+
+    rng = np.random.default_rng(args.seed)
+    centroids = rng.normal(size=(args.topics, DIMENSIONS))
+    centroids /= np.linalg.norm(centroids, axis=1, keepdims=True)
+    now = datetime.now(timezone.utc)
+
+    encode = None
+    if not args.skip_model:
+        from app.encoder import model as encoder_model
+        encode = lambda texts: encoder_model.encode(texts, batch_size=128, normalize_embeddings=True)
+
+    conn = await asyncpg.connect(connect_url())
+    await register_vector(conn)
+    try:
+        if args.truncate:
+            await conn.execute("TRUNCATE userstats, postduplicatespending, postneighborsstale, postneighbors, postvotes, commentvotes, comments, refreshtokens, posts, users RESTART IDENTITY CASCADE")
+        # Building the HNSW index once at the end is far cheaper than maintaining it row by row
+        await conn.execute("DROP INDEX IF EXISTS posts_embedding_idx")
+
+        password_hash = utils.get_password_hash(args.password)
+        await copy_chunks(conn, "users",
+                          ("id", "username", "email", "password", "super_vote_balance", "created_at", "embedding"),
+                          user_chunks(args, rng, centroids, password_hash, now), args.users)
+        await copy_chunks(conn, "posts",
+                          ("id", "title", "content", "author_id", "published", "votes", "comments_count",
+                           "created_at", "modified_at", "embedding"),
+                          post_chunks(args, rng, centroids, encode, now), args.posts)
+        await copy_chunks(conn, "postvotes", ("user_id", "post_id", "direction", "is_super", "created_at"),
+                          vote_chunks(args, rng, now), args.votes)
+        await copy_chunks(conn, "comments",
+                          ("id", "content", "user_id", "post_id", "parent_id", "votes", "is_deleted",
+                           "created_at", "modified_at"),
+                          comment_chunks(args, rng, now), args.comments)
+
+        print("denormalized counters...")
+        await conn.execute("""
+            UPDATE posts SET votes = v.total
+            FROM (SELECT post_id, sum(direction) AS total FROM postvotes GROUP BY post_id) v
+            WHERE posts.id = v.post_id""")
+        await conn.execute("""
+            UPDATE posts SET comments_count = c.total
+            FROM (SELECT post_id, count(*) AS total FROM comments GROUP BY post_id) c
+            WHERE posts.id = c.post_id""")
+        await conn.execute("""
+            INSERT INTO userstats (user_id, post_count, comment_count, post_karma, comment_karma)
+            SELECT u.id, coalesce(p.posts, 0), coalesce(c.comments, 0), coalesce(p.karma, 0), coalesce(c.karma, 0)
+            FROM users AS u
+            LEFT JOIN (SELECT author_id, count(*) AS posts, sum(votes) AS karma FROM posts GROUP BY author_id) p
+                ON p.author_id = u.id
+            LEFT JOIN (SELECT user_id, count(*) AS comments, sum(votes) AS karma FROM comments GROUP BY user_id) c
+                ON c.user_id = u.id
+            ON CONFLICT (user_id) DO UPDATE SET
+                post_count = excluded.post_count, comment_count = excluded.comment_count,
+                post_karma = excluded.post_karma, comment_karma = excluded.comment_karma""")
+        # Related-post lists and duplicate clusters are left to the scheduler (app.neighbors, app.duplicates)
+        await conn.execute("INSERT INTO postneighborsstale (post_id) SELECT id FROM posts ON CONFLICT DO NOTHING")
+        await conn.execute("INSERT INTO postduplicatespending (post_id) SELECT id FROM posts ON CONFLICT DO NOTHING")
+        for table in ("users", "posts", "comments"):
+            await conn.execute(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), coalesce((SELECT max(id) FROM {table}), 1))"
+            )
+
+        print("hnsw index...")
+        start = time.perf_counter()
+        await conn.execute("SET maintenance_work_mem = '1GB'")
+        await conn.execute("CREATE INDEX posts_embedding_idx ON posts USING hnsw (embedding vector_cosine_ops)")
+        print(f"hnsw index built in {time.perf_counter() - start:.1f}s")
+        await conn.execute("ANALYZE")
+    finally:
+        await conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--posts", type=int, default=50_000)
+    parser.add_argument("--votes", type=int, default=500_000, help="upper bound, repeated (user, post) pairs are dropped")
+    parser.add_argument("--comments", type=int, default=200_000)
+    parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent of post popularity")
+    parser.add_argument("--reply-ratio", type=float, default=0.7, help="share of comments that answer another one")
+    parser.add_argument("--days", type=int, default=30, help="spread of created_at")
+    parser.add_argument("--topics", type=int, default=64, help="centroids for random embeddings")
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--skip-model", action="store_true", help="random unit vectors instead of encode_text")
+    parser.add_argument("--truncate", action="store_true", help="empty the tables first")
+    args = parser.parse_args()
+    asyncio.run(seed(args))
+
+
+if __name__ == "__main__":
+    main()